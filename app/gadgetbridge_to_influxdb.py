@@ -24,15 +24,48 @@ Redistribution and use in source and binary forms, with or without modification,
 THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 '''
 
+import argparse
+import atexit
+import base64
+import calendar
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import functools
+import gzip
+import importlib
+import io
+import itertools
+import json
+import math
+import multiprocessing
+import operator
 import os
+import queue
+import random
+import select
 import shutil
+import signal
 import sqlite3
+import struct
 import sys
 import tempfile
+import threading
 import time
-from webdav3.client import Client
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# webdav3, influxdb_client and NumPy pull in large dependency trees, so
+# are imported (with lazy_import) when first needed rather than here
+#
+# NumPy is optional, it's used to speed up generation of per-minute points.
+# It's None until column_engine_enabled() tries to import it, and False
+# if that failed
+numpy = None
 
 
 ### Config section
@@ -55,6 +88,94 @@ EXPORT_FILE = os.getenv("EXPORT_FILENAME", "gadgetbridge")
 # How far back in time should we query when extracting stats?
 QUERY_DURATION = int(os.getenv("QUERY_DURATION", 86400))
 
+# Where should the sync state (the last timestamp exported for each
+# table and device) be kept? If unset, every run queries QUERY_DURATION
+STATE_FILE = os.getenv("STATE_FILE", "")
+
+# How far back (in seconds) from the last exported timestamp should
+# queries start? This allows for rows which are synced late
+STATE_OVERLAP = int(os.getenv("STATE_OVERLAP", 3600))
+
+# If sync state is being recorded, should runs which find the same
+# export as last time exit without downloading it?
+SKIP_UNCHANGED = os.getenv("SKIP_UNCHANGED", "Y")
+
+# If set, the export will be downloaded into this directory and kept
+# there, so that it doesn't need to be downloaded again if a run fails
+EXPORT_CACHE_DIR = os.getenv("EXPORT_CACHE_DIR", "")
+
+# Keep a digest of each hour of each table in the state, and re-extract
+# hours which have changed since the last run, however old they are
+DIFF_SYNC = os.getenv("DIFF_SYNC", "N")
+# How far back (in seconds) to digest and look for changes. 0 for no limit
+DIFF_LOOKBACK = int(os.getenv("DIFF_LOOKBACK", 2592000))
+
+# Read the export from this local path (for example, a directory kept
+# in sync by Syncthing) rather than fetching it from WebDAV
+EXPORT_PATH = os.getenv("EXPORT_PATH", "")
+# How long (in seconds) a local export's size and modification time must
+# stay the same before it's considered to have been completely written
+EXPORT_SETTLE_TIME = float(os.getenv("EXPORT_SETTLE_TIME", 2))
+
+# How many rows should be read from the database at a time?
+QUERY_FETCH_SIZE = int(os.getenv("QUERY_FETCH_SIZE", 1000))
+
+# Open the downloaded database read-only (and immutable) and tune
+# SQLite's memory use for a read-heavy workload
+SQLITE_OPTIMIZE = os.getenv("SQLITE_OPTIMIZE", "Y")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 268435456))
+# In KiB
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", 65536))
+
+# Should an index on TIMESTAMP be added to tables which lack one? Only
+# tables with at least SQLITE_INDEX_MIN_ROWS rows are indexed
+SQLITE_BUILD_INDEXES = os.getenv("SQLITE_BUILD_INDEXES", "N")
+SQLITE_INDEX_MIN_ROWS = int(os.getenv("SQLITE_INDEX_MIN_ROWS", 100000))
+
+# Exports up to this many bytes are downloaded into memory and loaded
+# from there rather than being written to disk. 0 disables
+IN_MEMORY_MAX_SIZE = int(os.getenv("IN_MEMORY_MAX_SIZE", 0))
+
+# Should hourly and daily rollups (step totals, heart rate, time at each
+# stress level and, if sleep is enabled, nightly sleep stage totals) be
+# written into ROLLUP_MEASUREMENT?
+ROLLUPS = os.getenv("ROLLUPS", "N")
+ROLLUP_MEASUREMENT = os.getenv("ROLLUP_MEASUREMENT", "gadgetbridge_rollups")
+
+# The script's own timings and counters are written into this
+# measurement at the end of each run. Set to an empty string to disable
+SELF_MONITOR_MEASUREMENT = os.getenv("SELF_MONITOR_MEASUREMENT", "gadgetbridge_to_influxdb")
+# If set, they're also written to this file in Prometheus text format
+# (for node_exporter's textfile collector)
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE", "")
+
+# Run continuously, polling the export for changes every POLL_INTERVAL
+# seconds (plus up to POLL_JITTER seconds, to avoid runs aligning)
+DAEMON_MODE = os.getenv("DAEMON_MODE", "N")
+POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", 300))
+POLL_JITTER = int(os.getenv("POLL_JITTER", 30))
+
+# In daemon mode, serve /health and /metrics on this port. 0 disables
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", 0))
+HEALTH_ADDRESS = os.getenv("HEALTH_ADDRESS", "0.0.0.0")
+
+# Process many users' exports in a single pass. If set, this is a JSON
+# file listing them, see README
+TENANTS_FILE = os.getenv("TENANTS_FILE", "")
+# How many exports to process at once, and how many of those may be
+# downloading at any one time
+TENANT_WORKERS = int(os.getenv("TENANT_WORKERS", 4))
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", 2))
+
+# How many tables should be extracted concurrently? Each worker uses
+# its own read-only connection. The pool can be "thread" or "process"
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", 1))
+EXTRACT_POOL = os.getenv("EXTRACT_POOL", "thread")
+
+# How many batches of extracted lines may be waiting to be written
+# before the workers are made to wait
+EXTRACT_QUEUE_SIZE = int(os.getenv("EXTRACT_QUEUE_SIZE", 16))
+
 # InfluxDB settings
 INFLUXDB_URL = os.getenv("INFLUXDB_URL", False)
 INFLUXDB_TOKEN = os.getenv("INFLUXDB_TOKEN", "")
@@ -62,6 +183,29 @@ INFLUXDB_ORG = os.getenv("INFLUXDB_ORG", "")
 INFLUXDB_MEASUREMENT = os.getenv("INFLUXDB_MEASUREMENT", "gadgetbridge")
 INFLUXDB_BUCKET = os.getenv("INFLUXDB_BUCKET", "testing_db")
 
+# How many lines should be sent per write request, and how often (in ms)
+# should a partially filled batch be flushed?
+INFLUXDB_BATCH_SIZE = int(os.getenv("INFLUXDB_BATCH_SIZE", 5000))
+INFLUXDB_FLUSH_INTERVAL = int(os.getenv("INFLUXDB_FLUSH_INTERVAL", 1000))
+
+# Should request bodies be gzipped?
+INFLUXDB_GZIP = os.getenv("INFLUXDB_GZIP", "Y")
+
+# If set, batches are appended to a spool in this directory and sent on
+# to InfluxDB in the background. Anything that can't be sent is kept
+# and replayed by the next run
+SPOOL_DIR = os.getenv("SPOOL_DIR", "")
+# Maximum size of the spool in bytes (compressed). When it's full,
+# extraction waits for it to drain, for up to SPOOL_FULL_TIMEOUT seconds
+SPOOL_MAX_SIZE = int(os.getenv("SPOOL_MAX_SIZE", 268435456))
+SPOOL_FULL_TIMEOUT = int(os.getenv("SPOOL_FULL_TIMEOUT", 600))
+# Failed sends are retried after SPOOL_RETRY_MIN seconds, doubling
+# each time up to SPOOL_RETRY_MAX
+SPOOL_RETRY_MIN = float(os.getenv("SPOOL_RETRY_MIN", 1))
+SPOOL_RETRY_MAX = float(os.getenv("SPOOL_RETRY_MAX", 60))
+# How long to wait for the spool to drain at the end of a run
+SPOOL_DRAIN_TIMEOUT = int(os.getenv("SPOOL_DRAIN_TIMEOUT", 300))
+
 # Which hours should be considered sleeping hours?
 # utilities/gadgetbridge_to_influxdb#6
 SLEEP_HOURS = os.getenv("SLEEP_HOURS", "0,1,2,3,4,5,6").split(",")
@@ -72,495 +216,3396 @@ SLEEP_HOURS = os.getenv("SLEEP_HOURS", "0,1,2,3,4,5,6").split(",")
 REMOVE_TEMP_DB = os.getenv("REMOVE_TEMP_DB", "Y")
 EXPERIMENTAL_OPTS = os.getenv("EXPERIMENTAL_OPTS", "").split(",")
 
+# Comma seperated list of series (stress, sleep) which should be written
+# sparsely: rather than a point per minute, a single point per sample
+# is written, carrying the sample's duration
+SPARSE_SERIES = os.getenv("SPARSE_SERIES", "").split(",")
+
+# Per-minute stress and sleep points are generated with NumPy if it's
+# installed. Set to "python" to always use the pure-Python path
+EXPANSION_ENGINE = os.getenv("EXPANSION_ENGINE", "auto")
+
 ### Config ends
 
+# Settings which can be given per tenant in TENANTS_FILE, keyed by
+# the name of the environment variable they'd otherwise be read from
+TENANT_OPTIONS = {
+    "WEBDAV_URL" : "WEBDAV_URL",
+    "WEBDAV_PATH" : "WEBDAV_PATH",
+    "WEBDAV_USER" : "WEBDAV_USER",
+    "WEBDAV_PASS" : "WEBDAV_PASS",
+    "EXPORT_FILENAME" : "EXPORT_FILE",
+    "EXPORT_PATH" : "EXPORT_PATH",
+    "QUERY_DURATION" : "QUERY_DURATION",
+    "STATE_FILE" : "STATE_FILE",
+    "EXPORT_CACHE_DIR" : "EXPORT_CACHE_DIR",
+    "DIFF_SYNC" : "DIFF_SYNC",
+    "DIFF_LOOKBACK" : "DIFF_LOOKBACK",
+    "METRICS_TEXTFILE" : "METRICS_TEXTFILE",
+    "INFLUXDB_BUCKET" : "INFLUXDB_BUCKET",
+    "INFLUXDB_ORG" : "INFLUXDB_ORG",
+    "INFLUXDB_MEASUREMENT" : "INFLUXDB_MEASUREMENT",
+    "ROLLUPS" : "ROLLUPS",
+    "ROLLUP_MEASUREMENT" : "ROLLUP_MEASUREMENT",
+    "SLEEP_HOURS" : "SLEEP_HOURS",
+    "EXPERIMENTAL_OPTS" : "EXPERIMENTAL_OPTS",
+    "SPARSE_SERIES" : "SPARSE_SERIES"
+    }
 
-def fetch_database(webdav_client):
-    ''' Connect to the WebDAV server and fetch the named database
-    file, if it exists.
-    
+# The name of the tenant being processed (if any)
+TENANT_NAME = ""
+
+# The global config, before any tenant's settings were applied
+BASE_CONFIG = None
+
+# Limits concurrent downloads when processing tenants
+DOWNLOAD_SLOTS = None
+
+# RAW_KIND values used by MI_BAND_ACTIVITY_SAMPLE for sleep phases
+SLEEP_KINDS = {
+    120 : "light",
+    121 : "deep",
+    122 : "REM",
+    249 : "very_light",
+    112 : "waking"
+    }
+
+# Selects the rows of MI_BAND_ACTIVITY_SAMPLE which are sleep phases
+SLEEP_FILTER = ("(RAW_KIND=112 "
+    "OR RAW_KIND BETWEEN 120 AND 122 "
+    "OR RAW_KIND=249)")
+
+
+def lazy_import(name):
+    ''' Import a module the first time it's needed, recording how
+    long that took
+    '''
+    module = sys.modules.get(name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        METRICS.add_time("import", time.perf_counter() - start)
+    return module
+
+
+def make_webdav_client():
+    ''' Create a WebDAV client from the config
+    '''
+    return lazy_import("webdav3.client").Client({
+        "webdav_hostname" : WEBDAV_URL,
+        "webdav_login" : WEBDAV_USER,
+        "webdav_password" : WEBDAV_PASS
+        })
+
+
+def validate_config(backfill=False):
+    ''' Check for problems with the config that can be found without
+    going near the network. Returns a list of errors
+    '''
+    errors = []
+    if not WEBDAV_URL and not EXPORT_PATH and (backfill or not TENANTS_FILE):
+        errors.append("WEBDAV_URL not set in environment")
+
+    # A backfill can write to files instead
+    if not INFLUXDB_URL:
+        if not backfill:
+            errors.append("INFLUXDB_URL not set in environment")
+    elif urllib.parse.urlparse(INFLUXDB_URL).scheme not in ("http", "https"):
+        errors.append("INFLUXDB_URL must be an http:// or https:// URL")
+
+    if EXPANSION_ENGINE not in ("auto", "python"):
+        errors.append("EXPANSION_ENGINE must be auto or python")
+    if EXTRACT_POOL not in ("thread", "process"):
+        errors.append("EXTRACT_POOL must be thread or process")
+
+    unknown = [series for series in SPARSE_SERIES if series not in ("", "stress", "sleep")]
+    if unknown:
+        errors.append(f"Unknown SPARSE_SERIES: {','.join(unknown)}")
+
+    if TENANTS_FILE and DAEMON_MODE == "Y" and not backfill:
+        errors.append("TENANTS_FILE can't be combined with DAEMON_MODE")
+    return errors
+
+
+def probe_export():
+    ''' Fetch the export's metadata with a single PROPFIND
+
+    This avoids importing (and setting up) the WebDAV client. The values
+    are as the client would return them, so they can be compared with
+    the fingerprint recorded in state. Returns None if the probe failed
+    '''
+    path = f"/{WEBDAV_PATH}/{EXPORT_FILE}"
+    while "//" in path:
+        path = path.replace("//", "/")
+
+    headers = {"Depth" : "0"}
+    if WEBDAV_USER:
+        credentials = f"{WEBDAV_USER}:{WEBDAV_PASS or ''}".encode("utf-8")
+        headers["Authorization"] = f"Basic {base64.b64encode(credentials).decode('ascii')}"
+
+    request = urllib.request.Request(WEBDAV_URL.rstrip("/") + urllib.parse.quote(path),
+                                     method="PROPFIND", headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            tree = xml.etree.ElementTree.fromstring(response.read())
+    except Exception as e:
+        print(f"Pre-flight check failed, continuing anyway: {e}")
+        return None
+
+    def prop(name):
+        element = tree.find(f".//{{DAV:}}{name}")
+        return element.text if element is not None else None
+
+    return {
+        "etag" : prop("getetag"),
+        "size" : prop("getcontentlength"),
+        "modified" : prop("getlastmodified")
+        }
+
+
+def preflight(source, state):
+    ''' Check, as cheaply as possible, whether the export has changed
+    since the last successful run
+
+    If it hasn't, the check point is written and True is returned,
+    without the WebDAV or InfluxDB clients ever being loaded
+    '''
+    if SKIP_UNCHANGED != "Y" or not state.get("export"):
+        return False
+
+    with METRICS.timer("preflight"):
+        info = source.probe()
+    if info is None or not export_unchanged(info, state):
+        return False
+
+    print("Export unchanged since last run, nothing to do")
+    write_results([export_check_row(info, False)], write_api=UrllibWriteAPI())
+    return True
+
+
+def get_export_info(webdav_client):
+    ''' Check that the export exists on the WebDAV server and
+    return its metadata (etag, size, modified etc)
+
+    Returns None if it doesn't exist
     '''
     file_list = webdav_client.list(WEBDAV_PATH)
     if EXPORT_FILE in file_list:
         info = webdav_client.info(f'{WEBDAV_PATH}/{EXPORT_FILE}')
     else:
         print("Error: Export file does not exist")
-        sys.exit(1)
-        
+        return None
+
+    return info
+
+
+def export_fingerprint(info):
+    ''' Reduce export metadata to the attributes which tell us
+    whether the file has changed
+    '''
+    return {
+        "etag" : info.get("etag"),
+        "size" : info.get("size"),
+        "modified" : info.get("modified")
+        }
+
+
+def export_unchanged(info, state):
+    ''' Is the export the same one that the last successful run
+    processed?
+    '''
+    previous = state.get("export")
+    if not previous:
+        return False
+
+    current = export_fingerprint(info)
+    if not any(current.values()):
+        # The server didn't give us anything to compare
+        return False
+
+    return current == previous
+
+
+def fetch_database(webdav_client, info=None, in_memory=True):
+    ''' Connect to the WebDAV server and fetch the named database
+    file, if it exists.
+
+    If EXPORT_CACHE_DIR is set, the file is downloaded there instead
+    of into a temporary directory. If the cached copy matches the
+    remote file (for example because the previous run failed to
+    write) it's used without being downloaded again.
+
+    Small exports are loaded into memory unless in_memory is False
+    '''
+    if info is None:
+        info = get_export_info(webdav_client)
+        if info is None:
+            sys.exit(1)
+
+    if EXPORT_CACHE_DIR:
+        return fetch_cached_database(webdav_client, info)
+
+    if in_memory and fits_in_memory(info):
+        return fetch_into_memory(webdav_client)
+
     # Create a temporary directory to operate from
     tempdir = tempfile.mkdtemp()
     # Download the file
     webdav_client.download_sync(remote_path=f'{WEBDAV_PATH}/{EXPORT_FILE}', local_path=f'{tempdir}/gadgetbridge.sqlite')
+    METRICS.count("download_bytes", os.path.getsize(f"{tempdir}/gadgetbridge.sqlite"))
     
     return tempdir
 
 
-def open_database(tempdir):
-    ''' Open a handle on the database
+class MemoryDatabase:
+    ''' An export held in memory rather than in a directory on disk
+
+    data is the database file's contents
     '''
-    conn = sqlite3.connect(f"{tempdir}/gadgetbridge.sqlite")
-    cur = conn.cursor()
-    
-    return conn, cur
 
+    def __init__(self, data):
+        self.data = data
 
-def extract_data(cur):
-    ''' Query the database for data
+
+def fits_in_memory(info):
+    ''' Check whether the export should be loaded into memory
+
+    The server has to tell us the size, and this Python's sqlite3 must
+    support deserialize (3.11+), otherwise we fall back to disk
     '''
-    results = []
-    devices = {}
-    devices_observed = {}
-    query_start_bound = int(time.time()) - QUERY_DURATION
-    # Some tables use ms timestamps
-    query_start_bound_ms = query_start_bound * 1000
+    if not IN_MEMORY_MAX_SIZE or not hasattr(sqlite3.Connection, "deserialize"):
+        return False
 
-    # Pull out device names
-    device_query = "select _id, NAME from DEVICE"
     try:
-        res = cur.execute(device_query)
-    except sqlite3.OperationalError as e: 
-        # We received an empty db
-        print("Unable to fetch stats - received an empty database")
+        return int(info.get("size")) <= IN_MEMORY_MAX_SIZE
+    except (TypeError, ValueError):
         return False
-    
-    for r in res.fetchall():
-        devices[f"dev-{r[0]}"] = r[1]
 
-    # Get SpO2 info
-    spo2_data_query = ("SELECT TIMESTAMP, DEVICE_ID, TYPE_NUM, SPO2 FROM HUAMI_SPO2_SAMPLE "
-        f"WHERE TIMESTAMP >= {query_start_bound_ms} "
-        "ORDER BY TIMESTAMP ASC")
 
-    res = cur.execute(spo2_data_query)
-    for r in res.fetchall():
-        row_ts = r[0] * 1000000 # Convert to nanos
-        row = {
-                "timestamp": row_ts, 
-                "fields" : {
-                    "spo2" : r[3]
-                    },
-                "tags" : {
-                    "type_num" : r[2],
-                    "device" : devices[f"dev-{r[1]}"]
-                    }
-            }
-        results.append(row)
-        if f"dev-{r[1]}" not in devices_observed or devices_observed[f"dev-{r[1]}"] < row_ts:
-            devices_observed[f"dev-{r[1]}"] = row_ts
-    
-    stress_data_query = ("SELECT TIMESTAMP, DEVICE_ID, TYPE_NUM, STRESS, "
-        # Get the next timestamp, so we can chart how long the watch believed that 
-        # stress level lasted
-        "LEAD (TIMESTAMP, 1) OVER (PARTITION BY DEVICE_ID, USER_ID, TYPE_NUM ORDER BY TIMESTAMP) NEXT_TS "
-        "FROM HUAMI_STRESS_SAMPLE "
-        f"WHERE TIMESTAMP >= {query_start_bound_ms} "
-        "ORDER BY TIMESTAMP ASC")
-    res = cur.execute(stress_data_query)
-    for r in res.fetchall():
-        # Note, the timestamps for these items in the SQliteDB are in ms not S
-        row_ts = r[0] * 1000000
-        row = {
-                "timestamp": row_ts, 
-                "fields" : {
-                    "stress" : r[3]
-                    },
-                "tags" : {
-                    "type_num" : r[2],
-                    "device" : devices[f"dev-{r[1]}"]
-                    }
-            }
-        
-        
-        # Convert the timestamp to a time object so that we can check what hour of
-        # the day it currently represents
-        # 
-        # If it's outside of sleeping hours we'll add a field
-        #
-        # utilities/gadgetbridge_to_influxdb#6
-        if str(time.gmtime(r[0] / 1000).tm_hour) not in SLEEP_HOURS:
-            row['fields']['stress_exc_sleep'] = r[3]
-        
-        results.append(row)
-        if f"dev-{r[1]}" not in devices_observed or devices_observed[f"dev-{r[1]}"] < row_ts:
-            devices_observed[f"dev-{r[1]}"] = row_ts        
-    
-        # Iterate between timestamp and next_ts, creating points to note the stress level
-        # convert from ms to s
-        if r[4]:
-            stress_period_start = r[0] / 1000
-            stress_period_end = r[4] / 1000
-            while stress_period_start < stress_period_end:
-                row_ts = int(stress_period_start * 1000000000)
-                # Calculate the textual stress level for use in
-                # the counter field name
-                #
-                # these thresholds were taken from the Zepp app
-                stress_level = "stress_level_counter_unknown"
-                if r[3] <= 39:
-                    stress_level = "stress_level_counter_relaxed"
-                elif r[3] >= 40 and r[3] <= 59:
-                    stress_level = "stress_level_counter_normal"
-                elif r[3] >= 60 and r[3] <= 79:
-                    stress_level = "stress_level_counter_medium"
-                elif r[3] >= 80:
-                    stress_level = "stress_level_counter_high"
-                
-                row = {
-                        "timestamp": row_ts, 
-                        "fields" : {
-                            "current_stress_level" : r[3],
-                            stress_level: 1,
-                            },
-                        "tags" : {
-                            "type_num" : r[2],
-                            "device" : devices[f"dev-{r[1]}"],
-                            "stress" : "point_in_time"
-                            }
-                    }  
-                        
-                # Check whether we're looking at a non sleeping hour
-                if str(time.gmtime(stress_period_start).tm_hour) not in SLEEP_HOURS:
-                    # Add a counter
-                    row['fields'][f"{stress_level}_exc_sleep"] = 1
-                    
-                results.append(row)
-                stress_period_start += 60
+def fetch_into_memory(webdav_client):
+    ''' Download the export into memory
+    '''
+    buff = io.BytesIO()
+    webdav_client.download_from(buff=buff, remote_path=f'{WEBDAV_PATH}/{EXPORT_FILE}')
+    data = buff.getvalue()
+    METRICS.count("download_bytes", len(data))
+    return MemoryDatabase(without_wal(data))
 
-    
-    
-    data_query = ("SELECT TIMESTAMP, DEVICE_ID, RATE FROM HUAMI_SLEEP_RESPIRATORY_RATE_SAMPLE "
-        f"WHERE TIMESTAMP >= {query_start_bound_ms} "
-        "ORDER BY TIMESTAMP ASC")
-    
-    res = cur.execute(data_query)
-    for r in res.fetchall():
-        # I don't currently have any data examples of this, but I assume it will be in ms
-        # the saame as the other HUAMI_*SAMPLE entries
-        row_ts = r[0] * 1000000
-        row = {
-                "timestamp": row_ts, # Convert to nanos
-                "fields" : {
-                    "sleep_respiratory_rate" : r[2]
-                    },
-                "tags" : {
-                    "device" : devices[f"dev-{r[1]}"]
-                    }
-            }
-        results.append(row)
-        if f"dev-{r[1]}" not in devices_observed or devices_observed[f"dev-{r[1]}"] < row_ts:
-            devices_observed[f"dev-{r[1]}"] = row_ts                
 
+def without_wal(data):
+    ''' SQLite won't read a WAL mode database from memory, but the WAL
+    isn't part of the export anyway, so switch the header back to
+    rollback journal mode
+    '''
+    if data[18:20] == b"\x02\x02":
+        data = bytearray(data)
+        data[18:20] = b"\x01\x01"
+    return data
 
-    data_query = ("SELECT TIMESTAMP, DEVICE_ID, PAI_LOW, PAI_MODERATE, PAI_HIGH, TIME_LOW," 
-        "TIME_MODERATE, TIME_HIGH, PAI_TODAY, PAI_TOTAL "
-        "FROM HUAMI_PAI_SAMPLE "
-        f"WHERE TIMESTAMP >= {query_start_bound_ms} ORDER BY TIMESTAMP ASC")
-    
-    res = cur.execute(data_query)
-    for r in res.fetchall():
-        # Note, the timestamps for these items in the SQliteDB are in ms not S
-        row_ts = r[0] * 1000000
-        row = {
-                "timestamp": row_ts, # Convert to nanos
-                "fields" : {
-                    "pai_low" : r[2],
-                    "pai_moderate" : r[3],
-                    "pai_high" : r[4],
-                    "time_low" : r[5],
-                    "time_moderate" : r[6],
-                    "time_high" : r[7],
-                    "pai_today" : r[8],
-                    "pai_total" : r[9]
-                    },
-                "tags" : {
-                    "device" : devices[f"dev-{r[1]}"]
-                    }
-            }
-        results.append(row)    
-        if f"dev-{r[1]}" not in devices_observed or devices_observed[f"dev-{r[1]}"] < row_ts:
-            devices_observed[f"dev-{r[1]}"] = row_ts              
 
-    data_query = ("SELECT TIMESTAMP, DEVICE_ID, LEVEL, BATTERY_INDEX FROM BATTERY_LEVEL "
-        f"WHERE TIMESTAMP >= {query_start_bound} "
-        "ORDER BY TIMESTAMP ASC")
-    
-    res = cur.execute(data_query)
-    for r in res.fetchall():
-        row_ts = r[0] * 1000000000
-        row = {
-                "timestamp": row_ts ,
-                "fields" : {
-                    "battery_level" : r[2]
-                    },
-                "tags" : {
-                    "device" : devices[f"dev-{r[1]}"],
-                    "battery" : r[3]
-                    }
-            }
-        results.append(row)
-        if f"dev-{r[1]}" not in devices_observed or devices_observed[f"dev-{r[1]}"] < row_ts:
-            devices_observed[f"dev-{r[1]}"] = row_ts         
+def fetch_cached_database(webdav_client, info):
+    ''' Make sure EXPORT_CACHE_DIR holds a copy of the current export
+    '''
+    db_file = f"{EXPORT_CACHE_DIR}/gadgetbridge.sqlite"
+    meta_file = f"{EXPORT_CACHE_DIR}/gadgetbridge.json"
+    fingerprint = export_fingerprint(info)
 
+    try:
+        with open(meta_file, "r") as fh:
+            cached = json.load(fh)
+    except (OSError, ValueError):
+        cached = None
 
-    # Heart rates are spread across tables, depending on the sampling types
-    rate_types = {
-        "manual" : "HUAMI_HEART_RATE_MANUAL_SAMPLE",
-        "max" : "HUAMI_HEART_RATE_MAX_SAMPLE",
-        "resting" : "HUAMI_HEART_RATE_RESTING_SAMPLE"
-        }
-    
-    for rate_type in rate_types:
-        data_query = (f"SELECT TIMESTAMP, DEVICE_ID, HEART_RATE FROM {rate_types[rate_type]} "
-            f"WHERE TIMESTAMP >= {query_start_bound_ms} "
-            "ORDER BY TIMESTAMP ASC")
-        res = cur.execute(data_query)
-        for r in res.fetchall():
-            # I don't currently have any data examples of this, but I assume it will be in ms
-            # the saame as the other HUAMI_*SAMPLE entries            
-            row_ts = r[0] * 1000000
-            row = {
-                    "timestamp": row_ts, # Convert to nanos
-                    "fields" : {
-                        "heart_rate" : r[2]
-                        },
-                    "tags" : {
-                        "device" : devices[f"dev-{r[1]}"],
-                        "sample_type" : rate_type
-                        }
-                }
-            results.append(row)
-            if f"dev-{r[1]}" not in devices_observed or devices_observed[f"dev-{r[1]}"] < row_ts:
-                devices_observed[f"dev-{r[1]}"] = row_ts
-        
-    # Get values from the activity table
-    #
-    # Activity types are deliniated by the value of RAW_KIND
-    # but there isn't currently a reliable mapping for the 
-    # meaning of each. There are also suggestions online that
-    # the meanings sometimes change between firmware revisions
-    # 
-    # So, we'll just expose the value as a tag rather than attempting
-    # to map it to anything
-    data_query = ("SELECT TIMESTAMP, DEVICE_ID, RAW_INTENSITY, STEPS, RAW_KIND, HEART_RATE, SLEEP,"
-        "DEEP_SLEEP, REM_SLEEP FROM HUAMI_EXTENDED_ACTIVITY_SAMPLE " 
-        f"WHERE TIMESTAMP >= {query_start_bound} "
-        "ORDER BY TIMESTAMP ASC")
-    
-    res = cur.execute(data_query)
-    for r in res.fetchall():
-        row_ts = r[0] * 1000000000
-        row = {
-                "timestamp": row_ts, # Convert to nanos
-                "fields" : {
-                    "intensity" : r[2],
-                    "steps" : r[3],
-                    "heart_rate" : r[5],
-                    "sleep" : r[6],
-                    "deep_sleep" : r[7],
-                    "rem_sleep" : r[8],
-                    },
-                "tags" : {
-                    "device" : devices[f"dev-{r[1]}"],
-                    "activity_kind" : r[4],
-                    "sample_type" : "activity"
-                    }
-            }
-        results.append(row)
-        if f"dev-{r[1]}" not in devices_observed or devices_observed[f"dev-{r[1]}"] < row_ts:
-            devices_observed[f"dev-{r[1]}"] = row_ts        
+    if cached == fingerprint and any(fingerprint.values()) and os.path.exists(db_file):
+        print("Using cached copy of export")
+        METRICS.count("download_cache_hits")
+        return EXPORT_CACHE_DIR
 
-    # Get normal steps and HR measurements
-    data_query = ("SELECT TIMESTAMP, DEVICE_ID, RAW_INTENSITY, STEPS, RAW_KIND, HEART_RATE"
-        " FROM MI_BAND_ACTIVITY_SAMPLE " 
-        f"WHERE TIMESTAMP >= {query_start_bound} "
-        "ORDER BY TIMESTAMP ASC")    
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    # Remove the old metadata first so that an interrupted download
+    # can't be mistaken for a good copy
+    if os.path.exists(meta_file):
+        os.unlink(meta_file)
 
-    res = cur.execute(data_query)
-    for r in res.fetchall():
-        row_ts = r[0] * 1000000000
-        row = {
-                "timestamp": row_ts, # Convert to nanos
-                "fields" : {
-                    "intensity" : r[2],
-                    "steps" : r[3],
-                    "raw_intensity" : r[2],
-                    "raw_kind" : r[4],
-                    "heart_rate" : r[5]
-                    },
-                "tags" : {
-                    "device" : devices[f"dev-{r[1]}"],
-                    "sample_type" : "periodic_samples"
-                    }
-            }
+    webdav_client.download_sync(remote_path=f'{WEBDAV_PATH}/{EXPORT_FILE}', local_path=f'{db_file}.part')
+    os.replace(f"{db_file}.part", db_file)
+    METRICS.count("download_bytes", os.path.getsize(db_file))
+    with open(meta_file, "w") as fh:
+        json.dump(fingerprint, fh)
+
+    return EXPORT_CACHE_DIR
 
-        results.append(row)     
-        if f"dev-{r[1]}" not in devices_observed or devices_observed[f"dev-{r[1]}"] < row_ts:
-            devices_observed[f"dev-{r[1]}"] = row_ts           
 
+### Sources
+#
+# Where the export comes from. A source provides
+#
+#   info(): the export's metadata (etag, size, modified), or None if it
+#           doesn't exist
+#   probe(): the same, as cheaply as possible. May return None if unsure
+#   fetch(info, in_memory): a copy of the export, as a directory or a
+#           MemoryDatabase
+#   wait(timeout, stop): wait until the export might have changed, the
+#           timeout expires or the stop event is set
 
+class WebDAVSource:
+    ''' Fetches the export from WEBDAV_URL
 
-    results = results + get_sleep_data(cur, devices)
+    The client is only created when it's first needed
+    '''
 
+    def __init__(self):
+        self._client = None
 
-    # Create a field to record when we last synced, based on the values in devices_observed
-    now = time.time_ns()
-    for device in devices_observed:
-        row_ts = devices_observed[device]
-        row_age = now - row_ts
-        row = {
-                "timestamp": now,
-                "fields" : {
-                    "last_seen" : row_ts,
-                    "last_seen_age" : row_age
-                    },
-                "tags" : {
-                    "device" : devices[device],
-                    "sample_type" : "sync_check"
-                    }
-            }
-        results.append(row)   
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = make_webdav_client()
+        return self._client
 
-    return results
+    def info(self):
+        return get_export_info(self.client)
 
+    def probe(self):
+        return probe_export()
 
-def get_sleep_data(cur, devices):
-    ''' Attempt to fetch sleep data and calculate periods
+    def fetch(self, info, in_memory=True):
+        return fetch_database(self.client, info, in_memory)
+
+    def wait(self, timeout, stop):
+        # There's no way to be notified of changes, so we just poll
+        stop.wait(timeout)
+
+
+class LocalSource:
+    ''' Reads the export from a local path
+
+    Rather than copying the file, a snapshot is taken with SQLite's
+    backup API so that it's consistent even if the file is written to
+    while we're reading it
     '''
-    if "SLEEP" not in EXPERIMENTAL_OPTS:
-        return []
-    
-    print("Experimental: Sleep Data")
-    results = []
-    # Capture sleep data
-    # utilities/gadgetbridge_to_influxdb#14
-    data_query = ("SELECT TIMESTAMP, DEVICE_ID, RAW_INTENSITY, RAW_KIND, "
-    "LEAD (TIMESTAMP, 1) OVER (PARTITION BY DEVICE_ID, USER_ID ORDER BY TIMESTAMP) NEXT_TS, "
-    "LEAD (RAW_KIND, 1) OVER (PARTITION BY DEVICE_ID, USER_ID ORDER BY TIMESTAMP) NEXT_KIND "
-    "FROM MI_BAND_ACTIVITY_SAMPLE "
-    "WHERE "
-    "(RAW_KIND=112 "
-    "OR RAW_KIND BETWEEN 120 AND 122 "
-    "OR RAW_KIND=249) "
-    "ORDER BY TIMESTAMP "
-    )  
 
-    res = cur.execute(data_query)
-    for r in res.fetchall():
-        
-        if r[3] == 120:
-            sleep_type = "light"
-        elif r[3] == 121:
-            sleep_type = "deep"
-        elif r[3] == 122:
-            sleep_type = "REM"
-        elif r[3] == 249:
-            sleep_type = "very_light"
-        elif r[3] == 112:
-            sleep_type = "waking"
-       
-        row_ts = r[0] * 1000000000
-        row = {
-                "timestamp": row_ts, # Convert to nanos
-                "fields" : {
-                    "intensity" : r[2],
-                    f"{sleep_type}_sleep" : 1
-                    },
-                "tags" : {
-                    "device" : devices[f"dev-{r[1]}"],
-                    "sample_type" : "sleep",
-                    "sleep" : "state-change"
-                    }
+    def __init__(self, path):
+        self.path = path
+        self.watcher = None
+
+    def info(self):
+        ''' Get the export's metadata, once it has stopped being written to
+
+        This is what's recorded in state, so it needs to describe the
+        file that fetch() will snapshot
+        '''
+        try:
+            st = self.wait_until_settled()
+        except FileNotFoundError:
+            print("Error: Export file does not exist")
+            return None
+        return self.stat_info(st)
+
+    def probe(self):
+        try:
+            return self.stat_info(os.stat(self.path))
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def stat_info(st):
+        return {
+            "etag" : f"{st.st_ino:x}-{st.st_mtime_ns:x}",
+            "size" : str(st.st_size),
+            "modified" : str(st.st_mtime_ns)
             }
-        
-        results.append(row)
 
-        # Generate the per-minute stats
-        if r[4] and sleep_type not in ["waking"]:
-            sleep_start = r[0]
-            sleep_end = r[4]
+    def wait_until_settled(self):
+        ''' Wait until the export's size and modification time have been
+        steady for EXPORT_SETTLE_TIME, so that we don't read it mid-write
 
-            while sleep_start < sleep_end:
-                row_ts = sleep_start * 1000000000
-                row = {
-                        "timestamp": row_ts, # Convert to nanos
-                        "fields" : {
-                            "intensity" : r[2],
-                            f"{sleep_type}_sleep" : 1,
-                            "sleep_stage" : sleep_type
-                            },
-                        "tags" : {
-                            "device" : devices[f"dev-{r[1]}"],
-                            "sample_type" : "sleep",
-                            "sleep" : "point-in-time"
-                            }
-                    }
-                results.append(row)
-                sleep_start += 60    
-    
-    return results
-    
+        Returns the settled file's stat
+        '''
+        st = os.stat(self.path)
+        if time.time() - st.st_mtime >= EXPORT_SETTLE_TIME:
+            # It's not been written to for long enough already
+            return st
+
+        previous = None
+        while True:
+            st = os.stat(self.path)
+            current = (st.st_size, st.st_mtime_ns)
+            if current == previous:
+                return st
+            previous = current
+            time.sleep(EXPORT_SETTLE_TIME)
+
+    def fetch(self, info, in_memory=True):
+        ''' Snapshot the export. info() has already waited for it to
+        settle
+        '''
+        if self.watcher:
+            # Events for writes we're about to pick up can be ignored
+            self.watcher.last = self.watcher.stat()
+
+        source = sqlite3.connect(f"file:{urllib.parse.quote(self.path)}?mode=ro", uri=True)
+        try:
+            if in_memory and fits_in_memory(info):
+                dest = sqlite3.connect(":memory:")
+                source.backup(dest)
+                snapshot = MemoryDatabase(without_wal(dest.serialize()))
+            else:
+                snapshot = tempfile.mkdtemp()
+                dest = sqlite3.connect(f"{snapshot}/gadgetbridge.sqlite")
+                source.backup(dest)
+            dest.close()
+        finally:
+            source.close()
 
-def write_results(results):
-    ''' Open a connection to InfluxDB and write the results in
+        METRICS.count("download_bytes", int(info["size"]))
+        return snapshot
+
+    def wait(self, timeout, stop):
+        if self.watcher is None:
+            self.watcher = ExportWatcher(self.path)
+        self.watcher.wait(timeout, stop)
+
+
+# inotify event types, from linux/inotify.h
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+
+
+def inotify_watch(directory):
+    ''' Start watching directory for files being written, created or
+    moved into it. Returns the inotify file descriptor
+
+    Raises OSError if inotify isn't available
     '''
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        raise OSError("inotify is not supported on this platform")
 
-    with InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG) as _client:
-        with _client.write_api() as _write_client:
-            # Iterate through the results generating and writing points
-            for row in results:
-                p = Point(INFLUXDB_MEASUREMENT)
-                for tag in row['tags']:
-                    p = p.tag(tag, row['tags'][tag])
-                    
-                for field in row['fields']:
-                    if row['fields'][field] == -1:
-                        continue
-                    
-                    # Skip any special heart_rate values
-                    # utilities/gadgetbridge_to_influxdb#1
-                    if field == "heart_rate" and row['fields'][field] > 253:
-                        continue
-                    
-                    p = p.field(field, row['fields'][field])
-                    
-                p = p.time(row['timestamp'])
-                _write_client.write(INFLUXDB_BUCKET, INFLUXDB_ORG, p)
-                
-    
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
 
-if __name__ == "__main__":
-    if not WEBDAV_URL:
-        print("Error: WEBDAV_URL not set in environment")
-        sys.exit(1)
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, f"Unable to watch {directory}")
+    return fd
 
-    if not INFLUXDB_URL:
-        print("Error: INFLUXDB_URL not set in environment")
-        sys.exit(1)
 
-    webdav_options = {
-        "webdav_hostname" : WEBDAV_URL,
-        "webdav_login" : WEBDAV_USER,
-        "webdav_password" : WEBDAV_PASS
-        }
+def inotify_names(fd):
+    ''' Read the pending events from an inotify file descriptor,
+    returning the names of the files they relate to
+    '''
+    names = set()
+    try:
+        data = os.read(fd, 65536)
+    except BlockingIOError:
+        return names
 
-    webdav_client = Client(webdav_options)
-    tempdir = fetch_database(webdav_client)
+    offset = 0
+    while offset < len(data):
+        # struct inotify_event: int wd; uint32 mask, cookie, len; char name[len]
+        wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+        offset += struct.calcsize("iIII")
+        names.add(os.fsdecode(data[offset:offset + length].rstrip(b"\0")))
+        offset += length
+    return names
 
-    conn, cur  = open_database(tempdir)
 
-    # Extract data from the DB
-    results = extract_data(cur)
-    if not results:
-        print("Data extraction failed")
-        sys.exit(1)
+class ExportWatcher:
+    ''' Waits for a local export to change
 
-    # Write out to InfluxDB
-    write_results(results)
-    
-    # Tidy up
-    conn.close()
-    if tempdir not in ["/", ""]:
+    Uses inotify where it's available, falling back to polling the
+    file's modification time
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.last = self.stat()
+        try:
+            self.fd = inotify_watch(os.path.dirname(os.path.abspath(path)))
+        except OSError as e:
+            print(f"Unable to use inotify ({e}), polling the export for changes")
+            self.fd = None
+
+    def stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_ino, st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+    def wait(self, timeout, stop):
+        ''' Wait for up to timeout seconds, returning True as soon as
+        the export changes
+        '''
+        deadline = time.monotonic() + timeout
+        while not stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            # Wake at least once a second so that stop is noticed
+            if self.fd is not None:
+                ready = select.select([self.fd], [], [], min(remaining, 1))[0]
+                if not ready or self.name not in inotify_names(self.fd):
+                    continue
+            else:
+                stop.wait(min(remaining, 1))
+
+            # A single write can generate several events, so make sure
+            # the file really is different to when we last looked
+            current = self.stat()
+            changed = current != self.last
+            self.last = current
+            if changed:
+                print("Export changed")
+                return True
+        return False
+
+
+def make_source():
+    ''' Create the source the export should be read from
+    '''
+    if EXPORT_PATH:
+        return LocalSource(EXPORT_PATH)
+    return WebDAVSource()
+
+
+def remove_database(tempdir):
+    ''' Tidy up the downloaded copy of the database
+    '''
+    if isinstance(tempdir, MemoryDatabase):
+        # Nothing was written to disk
+        return
+
+    if tempdir not in ["/", "", EXPORT_CACHE_DIR]:
         if REMOVE_TEMP_DB == "N":
             print(tempdir)
         else:
             shutil.rmtree(tempdir)
+
+
+def open_database(tempdir):
+    ''' Open a handle on the database
+
+    tempdir is the directory holding the downloaded copy, or a
+    MemoryDatabase
+    '''
+    in_memory = isinstance(tempdir, MemoryDatabase)
+    if SQLITE_BUILD_INDEXES == "Y":
+        if in_memory:
+            conn = sqlite3.connect(":memory:")
+            conn.deserialize(tempdir.data)
+            build_timestamp_indexes(conn)
+            # Extraction workers load their own copies, which
+            # need to include the indexes
+            tempdir.data = conn.serialize()
+        else:
+            conn = sqlite3.connect(f"{tempdir}/gadgetbridge.sqlite")
+            build_timestamp_indexes(conn)
+        conn.close()
+
+    if SQLITE_OPTIMIZE == "Y" or in_memory:
+        conn = connect_readonly(tempdir)
+    else:
+        conn = sqlite3.connect(f"{tempdir}/gadgetbridge.sqlite")
+    cur = conn.cursor()
+    
+    return conn, cur
+
+
+def connect_readonly(tempdir):
+    ''' Open a read-only connection to the database
+
+    Used by extraction workers, each of which needs its own
+
+    The file is our own copy and nothing else will be writing to it,
+    so unless there's a WAL alongside it we tell SQLite that it's
+    immutable. That allows it to skip locking and change detection.
+
+    A MemoryDatabase is deserialized into a new in-memory database, so
+    each connection gets its own copy
+    '''
+    if isinstance(tempdir, MemoryDatabase):
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        conn.deserialize(tempdir.data)
+        conn.execute("PRAGMA query_only=1")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    path = f"{tempdir}/gadgetbridge.sqlite"
+    uri = f"file:{urllib.parse.quote(path)}?mode=ro"
+    if SQLITE_OPTIMIZE == "Y" and not os.path.exists(f"{path}-wal"):
+        uri += "&immutable=1"
+
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    if SQLITE_OPTIMIZE == "Y":
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def has_timestamp_index(cur, table):
+    ''' Check whether table already has an index (including a
+    primary key) led by TIMESTAMP
+    '''
+    for index in cur.execute(f"PRAGMA index_list({table})").fetchall():
+        columns = cur.execute(f"PRAGMA index_info({index[1]})").fetchall()
+        if columns and columns[0][2] == "TIMESTAMP":
+            return True
+    return False
+
+
+def build_timestamp_indexes(conn):
+    ''' Add an index on (TIMESTAMP, DEVICE_ID) to any sampled table
+    which doesn't already have one
+
+    We're working on our own copy of the export, so this doesn't touch
+    the original. Building an index means reading the whole table, so
+    it's only done where the table is big enough for it to pay off
+    '''
+    cur = conn.cursor()
+    existing = {r[0] for r in cur.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    for table in TABLE_TIMESTAMP_UNITS:
+        if table not in existing or has_timestamp_index(cur, table):
+            continue
+
+        rows = cur.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        if rows < SQLITE_INDEX_MIN_ROWS:
+            continue
+
+        start = time.perf_counter()
+        cur.execute(f"CREATE INDEX IF NOT EXISTS gb2influx_{table}_ts ON {table} (TIMESTAMP, DEVICE_ID)")
+        print(f"Indexed {table} ({rows} rows) in {time.perf_counter() - start:.3f}s")
+
+    conn.commit()
+
+
+def load_state():
+    ''' Load the sync state saved by the previous run
+
+    Returns an empty state if there isn't one (or it can't be read)
+    '''
+    if not STATE_FILE or not os.path.exists(STATE_FILE):
+        return {}
+
+    try:
+        with open(STATE_FILE, "r") as fh:
+            return json.load(fh)
+    except (OSError, ValueError) as e:
+        print(f"Warning: unable to read state file, ignoring it: {e}")
+        return {}
+
+
+def save_state(state):
+    ''' Persist sync state for the next run
+
+    The file is written alongside and then moved into place so that
+    a crash mid-write can't leave a truncated state behind
+    '''
+    if not STATE_FILE:
+        return
+
+    tmp_file = f"{STATE_FILE}.tmp"
+    with open(tmp_file, "w") as fh:
+        json.dump(state, fh)
+    os.replace(tmp_file, STATE_FILE)
+
+
+def update_state(state, progress):
+    ''' Merge the high-water marks reached by this run into state
+
+    Marks keyed by (device, user) rather than device are kept under
+    "users", for tasks which need to know how far each user got
+    '''
+    tables = state.setdefault("tables", {})
+    for table in progress:
+        marks = tables.setdefault(table, {})
+        for device_id in progress[table]:
+            ts = progress[table][device_id]
+            if type(device_id) is tuple:
+                device_id, user_id = device_id
+                users = state.setdefault("users", {}).setdefault(table, {}).setdefault(str(device_id), {})
+                if ts > users.get(str(user_id), 0):
+                    users[str(user_id)] = ts
+            elif ts > marks.get(str(device_id), 0):
+                marks[str(device_id)] = ts
+
+    return state
+
+
+def timestamp_predicate(table, marks, start_bound, end_bound=None):
+    ''' Build the WHERE clause selecting rows from table that we
+    need to export
+
+    start_bound is in seconds, marks are in the table's own units.
+    Devices we have a high-water mark for start from that mark (less
+    STATE_OVERLAP, to catch rows that were synced late), anything
+    else starts at start_bound
+
+    If end_bound (seconds) is given, rows from then on are excluded
+    '''
+    scale = timestamp_scale(table)
+    if end_bound is not None:
+        predicate = timestamp_predicate(table, marks, start_bound)
+        return f"({predicate} AND TIMESTAMP < {end_bound * scale})"
+
+    default_start = start_bound * scale
+    table_marks = marks.get(table)
+    if not table_marks:
+        return f"TIMESTAMP >= {default_start}"
+
+    overlap = STATE_OVERLAP * scale
+    clauses = []
+    for device_id in table_marks:
+        clauses.append(f"(DEVICE_ID = {int(device_id)} AND TIMESTAMP >= {int(table_marks[device_id]) - overlap})")
+
+    known = ",".join(str(int(device_id)) for device_id in table_marks)
+    clauses.append(f"(DEVICE_ID NOT IN ({known}) AND TIMESTAMP >= {default_start})")
+    return "(" + " OR ".join(clauses) + ")"
+
+
+def device_start(table, marks, start_bound, device_id):
+    ''' Calculate the timestamp (in the table's units) that
+    timestamp_predicate will start device_id's rows from
+    '''
+    scale = timestamp_scale(table)
+    mark = marks.get(table, {}).get(str(device_id))
+    if mark is None:
+        return start_bound * scale
+    return int(mark) - STATE_OVERLAP * scale
+
+
+class Record:
+    ''' A single point to be written
+
+    tags is an interned tuple of (tag, value) pairs, sorted by tag.
+    names is a tuple of field names (also sorted) and values holds
+    the corresponding field values. Tables reuse the same names tuple
+    for every row, so each record only carries its own values.
+    '''
+    __slots__ = ("timestamp", "precision", "tags", "names", "values")
+
+    def __init__(self, timestamp, precision, tags, names, values):
+        self.timestamp = timestamp
+        self.precision = precision
+        self.tags = tags
+        self.names = names
+        self.values = values
+
+
+# Tagsets are shared between records
+TAG_INTERN = {}
+
+
+def intern_tags(tags):
+    ''' Convert a dict of tags into a shared, sorted, tuple
+    '''
+    key = tuple(sorted(tags.items()))
+    return TAG_INTERN.setdefault(key, key)
+
+
+def make_record(timestamp, precision, tags, fields):
+    ''' Build a Record from dicts of tags and fields
+
+    Used where convenience matters more than speed
+    '''
+    names = tuple(sorted(fields))
+    return Record(timestamp, precision, intern_tags(tags), names,
+                  tuple(fields[name] for name in names))
+
+
+def export_check_row(info, changed):
+    ''' Build a point recording whether this run found a new export
+    '''
+    fields = {"export_changed" : int(changed)}
+    try:
+        fields["export_size"] = int(info.get("size"))
+    except (TypeError, ValueError):
+        pass
+
+    return make_record(time.time_ns(), "ns", {"sample_type" : "export_check"}, fields)
+
+
+def iter_query_chunks(cur, query):
+    ''' Execute a query and yield the resulting rows in lists of
+    up to QUERY_FETCH_SIZE
+
+    Time spent in SQLite, and the number of rows read, is recorded
+    against the extraction task being run
+    '''
+    stats = METRICS.task_stats()
+    stats["queries"] += 1
+
+    start = time.perf_counter()
+    res = cur.execute(query)
+    while True:
+        rows = res.fetchmany(QUERY_FETCH_SIZE)
+        stats["query_seconds"] += time.perf_counter() - start
+        if not rows:
+            break
+        stats["rows"] += len(rows)
+        yield rows
+        start = time.perf_counter()
+
+
+def iter_query(cur, query):
+    ''' Execute a query and yield the resulting rows, fetching them
+    from the cursor in chunks rather than all at once
+    '''
+    for rows in iter_query_chunks(cur, query):
+        yield from rows
+
+
+def get_devices(cur):
+    ''' Pull out device names, keyed by device ID
+    '''
+    devices = {}
+    device_query = "select _id, NAME from DEVICE"
+    try:
+        res = cur.execute(device_query)
+    except sqlite3.OperationalError as e:
+        # We received an empty db
+        print("Unable to fetch stats - received an empty database")
+        return False
+
+    for r in res.fetchall():
+        devices[r[0]] = r[1]
+
+    return devices
+
+
+def last_seen(progress):
+    ''' Calculate the most recent timestamp (in ns) seen for each device
+    from the per-table high-water marks
+    '''
+    devices_observed = {}
+    for table in progress:
+        scale = 1000000000 // timestamp_scale(table)
+        for device_id in progress[table]:
+            if type(device_id) is tuple:
+                continue
+            row_ts = progress[table][device_id] * scale
+            if devices_observed.get(device_id, 0) < row_ts:
+                devices_observed[device_id] = row_ts
+
+    return devices_observed
+
+
+def extract_stress(cur, devices, window, marks):
+    ''' Get stress samples, along with a point per minute recording
+    the level the watch believed applied at the time
+    '''
+    # Marks are per device, but a sample lasts until the next one for the
+    # same user and type. Each of those partitions' last sample before
+    # the window is carried in, as its minutes won't have been expanded
+    # if the next sample hadn't arrived when it was exported. CARRY_FROM
+    # is set for those rows, and NULL for rows inside the window
+    carried = []
+    table_marks = window.marks.get("HUAMI_STRESS_SAMPLE", {})
+    for device_id in devices:
+        if str(device_id) in table_marks:
+            carried.append(" UNION ALL " + carry_query("HUAMI_STRESS_SAMPLE",
+                ("TIMESTAMP", "DEVICE_ID", "USER_ID", "TYPE_NUM", "STRESS"),
+                "DEVICE_ID, USER_ID, TYPE_NUM", "1", device_id,
+                window.start("HUAMI_STRESS_SAMPLE", device_id)))
+
+    next_ts = next_beyond(
+        "LEAD (TIMESTAMP, 1) OVER (PARTITION BY DEVICE_ID, USER_ID, TYPE_NUM ORDER BY TIMESTAMP)",
+        "HUAMI_STRESS_SAMPLE", "samples", ("DEVICE_ID", "USER_ID", "TYPE_NUM"), "1",
+        window.end("HUAMI_STRESS_SAMPLE")
+        )
+    stress_data_query = ("SELECT TIMESTAMP, DEVICE_ID, TYPE_NUM, STRESS, "
+        # Get the next timestamp, so we can chart how long the watch believed that
+        # stress level lasted
+        f"{next_ts} NEXT_TS, "
+        "CARRY_FROM "
+        "FROM ("
+        "SELECT TIMESTAMP, DEVICE_ID, USER_ID, TYPE_NUM, STRESS, NULL AS CARRY_FROM "
+        "FROM HUAMI_STRESS_SAMPLE "
+        f"WHERE {window('HUAMI_STRESS_SAMPLE')}"
+        f"{''.join(carried)}) samples "
+        "ORDER BY TIMESTAMP ASC")
+
+    sparse = "stress" in SPARSE_SERIES
+    if column_engine_enabled() and not sparse:
+        # Expand the whole chunk at once
+        templates = LineTemplates()
+        for rows in iter_query_chunks(cur, stress_data_query):
+            for r in rows:
+                if r[5] is None:
+                    marks[r[1]] = r[0]
+            yield LineBatch("ms", expand_stress_lines(rows, devices, templates))
+        return
+
+    tag_cache = {}
+    point_tag_cache = {}
+    for r in iter_query(cur, stress_data_query):
+        if r[5] is None:
+            marks[r[1]] = r[0]
+        # Note, the timestamps for these items in the SQliteDB are in ms not S
+        tags = tag_cache.get((r[1], r[2]))
+        if tags is None:
+            tags = tag_cache[(r[1], r[2])] = intern_tags({"type_num" : r[2], "device" : devices[r[1]]})
+            point_tag_cache[(r[1], r[2])] = intern_tags({
+                "type_num" : r[2],
+                "device" : devices[r[1]],
+                "stress" : "point_in_time"
+                })
+
+        # Convert the timestamp to a time object so that we can check what hour of
+        # the day it currently represents
+        #
+        # If it's outside of sleeping hours we'll add a field
+        #
+        # utilities/gadgetbridge_to_influxdb#6
+        #
+        # Carried in samples have already been exported, only their
+        # per-minute points are needed
+        if r[5] is None:
+            if str(time.gmtime(r[0] / 1000).tm_hour) not in SLEEP_HOURS:
+                yield Record(r[0], "ms", tags, ("stress", "stress_exc_sleep"), (r[3], r[3]))
+            else:
+                yield Record(r[0], "ms", tags, ("stress",), (r[3],))
+
+        if r[4] and sparse:
+            yield sparse_stress_row(r, devices)
+        # Iterate between timestamp and next_ts, creating points to note the stress level
+        #
+        # We stay in ms throughout so that the generated timestamps are exact
+        elif r[4]:
+            tags = point_tag_cache[(r[1], r[2])]
+
+            # Calculate the textual stress level for use in
+            # the counter field name
+            stress_level = stress_level_name(r[3])
+
+            names = ("current_stress_level", stress_level)
+            names_exc_sleep = ("current_stress_level", stress_level, f"{stress_level}_exc_sleep")
+
+            stress_period_start = r[0]
+            stress_period_end = r[4]
+            while stress_period_start < stress_period_end:
+                # Check whether we're looking at a non sleeping hour
+                if str(time.gmtime(stress_period_start / 1000).tm_hour) not in SLEEP_HOURS:
+                    # Add a counter
+                    yield Record(stress_period_start, "ms", tags, names_exc_sleep, (r[3], 1, 1))
+                else:
+                    yield Record(stress_period_start, "ms", tags, names, (r[3], 1))
+                stress_period_start += 60000
+
+
+def sparse_stress_row(r, devices):
+    ''' Build the single point which replaces a stress sample's
+    per-minute points in sparse mode
+
+    The counters hold the number of per-minute points that would have
+    been written, so sums over them are unchanged
+    '''
+    stress_level = stress_level_name(r[3])
+    hours = {}
+    count_interval(hours, None, stress_level, r[0], r[4], r[0], 60000, 3600000)
+
+    fields = {
+        "current_stress_level" : r[3],
+        "duration" : (r[4] - r[0]) // 1000,
+        stress_level : 0
+        }
+    for key, hour in hours:
+        minutes = hours[(key, hour)][stress_level]
+        fields[stress_level] += minutes
+        if str(time.gmtime(hour / 1000).tm_hour) not in SLEEP_HOURS:
+            exc_sleep = f"{stress_level}_exc_sleep"
+            fields[exc_sleep] = fields.get(exc_sleep, 0) + minutes
+
+    return make_record(r[0], "ms",
+        {"type_num" : r[2], "device" : devices[r[1]], "stress" : "state_change"},
+        fields
+        )
+
+
+def extract_sleep(cur, devices, window, marks):
+    ''' Wrap get_sleep_data so that it can be run as an extraction task
+    '''
+    yield from get_sleep_data(cur, devices, window, marks)
+
+
+def stress_level_name(stress):
+    ''' Get the counter field name for a stress value
+
+    these thresholds were taken from the Zepp app
+    '''
+    if stress <= 39:
+        return "stress_level_counter_relaxed"
+    elif stress >= 40 and stress <= 59:
+        return "stress_level_counter_normal"
+    elif stress >= 60 and stress <= 79:
+        return "stress_level_counter_medium"
+    elif stress >= 80:
+        return "stress_level_counter_high"
+    return "stress_level_counter_unknown"
+
+
+### Rollups
+#
+# Hourly and daily aggregates, so that dashboards covering long periods
+# don't need to aggregate hundreds of thousands of raw points.
+#
+# Buckets are aligned to UTC. Each run recomputes every bucket from the
+# one containing the earliest timestamp it extracted, using everything
+# in the database, so buckets which received new data are complete.
+
+ROLLUP_PERIODS = {
+    "1h" : 3600,
+    "1d" : 86400
+    }
+
+# Nights run from midday to midday (UTC), so that a night's sleep
+# isn't split across two buckets
+NIGHT_OFFSET = 43200
+
+
+def rollup_starts(window, task, devices, period, offset=0):
+    ''' Calculate, for each device, the start of the earliest bucket
+    touched by this run. Returned in the table's units
+    '''
+    scale = timestamp_scale(task)
+    starts = {}
+    for device_id in devices:
+        start = window.start(task, device_id) // scale
+        starts[device_id] = (start - (start - offset) % period) * scale
+    return starts
+
+
+def starts_predicate(starts):
+    ''' Build a WHERE clause selecting rows from each device's start
+    '''
+    if not starts:
+        return "0"
+    return "(" + " OR ".join(f"(DEVICE_ID = {int(device_id)} AND TIMESTAMP >= {starts[device_id]})"
+                             for device_id in starts) + ")"
+
+
+def lead_query(table, columns, partition, condition, starts):
+    ''' Build a query selecting columns from table (where condition holds)
+    along with NEXT_TS, the TIMESTAMP of the next row in the partition
+
+    The last row before each device's start is carried in for each
+    partition, so that the interval in progress at the start is included.
+    The final column, CARRY_FROM, is the device's start for those rows
+    and NULL otherwise
+    '''
+    selected = ", ".join(columns)
+    carried = []
+    for device_id in starts:
+        carried.append(" UNION ALL " + carry_query(table, columns, partition, condition,
+                                                  device_id, starts[device_id]))
+
+    return (f"SELECT {selected}, "
+        f"LEAD (TIMESTAMP, 1) OVER (PARTITION BY {partition} ORDER BY TIMESTAMP) NEXT_TS, "
+        "CARRY_FROM "
+        f"FROM (SELECT {selected}, NULL AS CARRY_FROM FROM {table} "
+        f"WHERE {condition} AND {starts_predicate(starts)}"
+        f"{''.join(carried)}) "
+        "ORDER BY TIMESTAMP")
+
+
+def count_interval(buckets, key, field, start, end, floor, step, period, offset=0):
+    ''' Count the per-minute points that an interval generates (at
+    start, start + step etc, up to end) into each bucket that it covers
+
+    Points before floor aren't counted. buckets is keyed by (key, bucket)
+    '''
+    low = max(start, floor)
+    bucket = low - (low - offset) % period
+    while bucket < end:
+        lo = max(bucket, low)
+        hi = min(bucket + period, end)
+        # The number of points falling in [lo, hi)
+        count = -((start - hi) // step) + ((start - lo) // step)
+        if count > 0:
+            fields = buckets.setdefault((key, bucket), {})
+            fields[field] = fields.get(field, 0) + count
+        bucket += period
+
+
+def rollup_lines(buckets, devices, period_name, divisor=1):
+    ''' Serialize rollup buckets into lines in ROLLUP_MEASUREMENT
+    '''
+    lines = []
+    for key, bucket in sorted(buckets, key=lambda b: b[1]):
+        device_id, rollup = key
+        row = make_record(bucket // divisor, "s",
+            {"device" : devices[device_id], "period" : period_name, "rollup" : rollup},
+            buckets[(key, bucket)]
+            )
+        line = serialize_row(row, ROLLUP_MEASUREMENT)
+        if line:
+            lines.append(line)
+    return lines
+
+
+def extract_activity_rollups(cur, devices, window, marks):
+    ''' Roll up steps and heart rate from MI_BAND_ACTIVITY_SAMPLE
+
+    Readings of 0 (no reading) and above 253 (special values) are
+    excluded from the heart rate figures
+    '''
+    names = ("heart_rate_max", "heart_rate_mean", "heart_rate_min", "samples", "steps")
+    for period_name in ROLLUP_PERIODS:
+        period = ROLLUP_PERIODS[period_name]
+        starts = rollup_starts(window, "MI_BAND_ACTIVITY_SAMPLE", devices, period)
+        valid_hr = "CASE WHEN HEART_RATE > 0 AND HEART_RATE < 254 THEN HEART_RATE END"
+        data_query = (f"SELECT DEVICE_ID, TIMESTAMP - TIMESTAMP % {period} AS BUCKET, "
+            f"MAX({valid_hr}), AVG({valid_hr}), MIN({valid_hr}), COUNT(*), "
+            "SUM(CASE WHEN STEPS >= 0 THEN STEPS END) "
+            "FROM MI_BAND_ACTIVITY_SAMPLE "
+            f"WHERE {starts_predicate(starts)} "
+            "GROUP BY DEVICE_ID, BUCKET ORDER BY BUCKET")
+
+        tag_cache = {}
+        for rows in iter_query_chunks(cur, data_query):
+            lines = []
+            for r in rows:
+                tags = tag_cache.get(r[0])
+                if tags is None:
+                    tags = tag_cache[r[0]] = intern_tags({
+                        "device" : devices[r[0]],
+                        "period" : period_name,
+                        "rollup" : "activity"
+                        })
+                line = serialize_row(Record(r[1], "s", tags, names, r[2:]), ROLLUP_MEASUREMENT)
+                if line:
+                    lines.append(line)
+            yield LineBatch("s", lines)
+
+
+def extract_stress_rollups(cur, devices, window, marks):
+    ''' Roll up the time (in minutes) spent at each stress level, with
+    and without SLEEP_HOURS
+
+    These are the sums of the per-minute counters written by extract_stress
+    '''
+    # Hourly buckets are computed from the start of the earliest touched
+    # day, so that the daily buckets can be summed from them
+    starts = rollup_starts(window, "HUAMI_STRESS_SAMPLE", devices, 86400)
+    data_query = lead_query("HUAMI_STRESS_SAMPLE", ("TIMESTAMP", "DEVICE_ID", "STRESS", "USER_ID", "TYPE_NUM"),
+                            "DEVICE_ID, USER_ID, TYPE_NUM", "1", starts)
+
+    hourly = {}
+    for rows in iter_query_chunks(cur, data_query):
+        for r in rows:
+            if not r[5]:
+                continue
+            level = stress_level_name(r[2])
+            floor = r[0] if r[6] is None else r[6]
+            count_interval(hourly, (r[1], "stress"), level, r[0], r[5], floor, 60000, 3600000)
+
+    daily = {}
+    for key, bucket in hourly:
+        fields = hourly[(key, bucket)]
+        if str(time.gmtime(bucket / 1000).tm_hour) not in SLEEP_HOURS:
+            for field in list(fields):
+                fields[f"{field}_exc_sleep"] = fields[field]
+        day = daily.setdefault((key, bucket - bucket % 86400000), {})
+        for field in fields:
+            day[field] = day.get(field, 0) + fields[field]
+
+    yield LineBatch("s", rollup_lines(hourly, devices, "1h", 1000))
+    yield LineBatch("s", rollup_lines(daily, devices, "1d", 1000))
+
+
+def extract_sleep_rollups(cur, devices, window, marks):
+    ''' Roll up the time (in minutes) spent in each sleep stage each night
+
+    These are the sums of the per-minute points written by get_sleep_data
+    '''
+    starts = rollup_starts(window, "sleep", devices, 86400, NIGHT_OFFSET)
+    data_query = lead_query("MI_BAND_ACTIVITY_SAMPLE", ("TIMESTAMP", "DEVICE_ID", "RAW_KIND", "USER_ID"),
+                            "DEVICE_ID, USER_ID", SLEEP_FILTER, starts)
+
+    nightly = {}
+    for rows in iter_query_chunks(cur, data_query):
+        for r in rows:
+            sleep_type = SLEEP_KINDS[r[2]]
+            if not r[4] or sleep_type == "waking":
+                continue
+            floor = r[0] if r[5] is None else r[5]
+            count_interval(nightly, (r[1], "sleep"), f"{sleep_type}_sleep", r[0], r[4], floor,
+                           60, 86400, NIGHT_OFFSET)
+
+    yield LineBatch("s", rollup_lines(nightly, devices, "night"))
+
+
+def make_converter(mapping, columns, devices):
+    ''' Build the function converting a chunk of rows from the query
+    built by extract_table into Records, recording high-water marks
+    as it goes
+
+    This is done once per table, so that the per-row work is just
+    picking values out of the row tuple
+    '''
+    precision = mapping["unit"]
+    static_tags = mapping.get("static_tags", {})
+    tag_index = {tag : columns.index(mapping["tags"][tag]) for tag in mapping.get("tags", {})}
+    names = tuple(sorted(field for field in mapping["fields"] if mapping["fields"][field] in columns))
+    value_index = [columns.index(mapping["fields"][field]) for field in names]
+
+    # itemgetter returns a bare value, rather than a tuple, if given one index
+    if len(value_index) == 1:
+        index = value_index[0]
+        get_values = lambda r: (r[index],)
+    else:
+        get_values = operator.itemgetter(*value_index)
+    get_tag_key = operator.itemgetter(1, *tag_index.values())
+
+    tag_cache = {}
+    def convert(rows, marks):
+        for r in rows:
+            marks[r[1]] = r[0]
+            key = get_tag_key(r)
+            tags = tag_cache.get(key)
+            if tags is None:
+                tags = {"device" : devices[r[1]], **static_tags}
+                for tag in tag_index:
+                    tags[tag] = r[tag_index[tag]]
+                tags = tag_cache[key] = intern_tags(tags)
+            yield Record(r[0], precision, tags, names, get_values(r))
+
+    return convert
+
+
+def table_columns(cur, table):
+    ''' List the columns that table has
+    '''
+    return [r[1] for r in cur.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def extract_table(task, cur, devices, window, marks):
+    ''' Extract a table described in TABLE_MAPPINGS, each row
+    becoming a single point
+
+    Fields whose columns don't exist in this export are skipped
+    '''
+    mapping = TABLE_MAPPINGS[task]
+    table = mapping.get("table", task)
+    existing = table_columns(cur, table)
+    wanted = list(mapping.get("tags", {}).values()) + list(mapping["fields"].values())
+    columns = ["TIMESTAMP", "DEVICE_ID"]
+    for column in wanted:
+        if column in existing and column not in columns:
+            columns.append(column)
+
+    missing = [column for column in wanted if column not in existing]
+    if missing:
+        print(f"Warning: {table} lacks columns {', '.join(missing)}, they'll be skipped")
+    if any(column not in existing for column in mapping.get("tags", {}).values()):
+        return
+
+    data_query = (f"SELECT {', '.join(columns)} FROM {table} "
+        f"WHERE {window(task)} "
+        "ORDER BY TIMESTAMP ASC")
+
+    convert = make_converter(mapping, columns, devices)
+    for rows in iter_query_chunks(cur, data_query):
+        yield from convert(rows, marks)
+
+
+# Describes each extraction task: where it reads from and how rows map
+# onto points. Most tables map each row onto a single point, tasks which
+# need more than that provide their own extractor
+#
+#   table: the table to read from (defaults to the task's name)
+#   unit: the unit TIMESTAMP is in. Gadgetbridge isn't consistent,
+#         some tables are in ms, others in seconds. Tasks with a unit
+#         have high-water marks recorded
+#   tags: tag name -> column (a device tag is always added)
+#   static_tags: tags with fixed values
+#   fields: field name -> column
+#   extractor: function(cur, devices, window, marks) yielding points
+#   digest: for tasks with an extractor, the columns (other than
+#           TIMESTAMP) and condition to digest when diffing exports.
+#           Other tasks digest the columns they map
+#
+# Tasks are independent of each other, so may be run in parallel.
+# Adding support for a new table should only require an entry here
+TABLE_MAPPINGS = {
+    "HUAMI_SPO2_SAMPLE" : {
+        "unit" : "ms",
+        "tags" : {"type_num" : "TYPE_NUM"},
+        "fields" : {"spo2" : "SPO2"}
+        },
+    "HUAMI_STRESS_SAMPLE" : {
+        "unit" : "ms",
+        "extractor" : extract_stress,
+        "digest" : (("USER_ID", "TYPE_NUM", "STRESS"), "1")
+        },
+    # I don't currently have any data examples of this, but I assume it will be in ms
+    # the saame as the other HUAMI_*SAMPLE entries
+    "HUAMI_SLEEP_RESPIRATORY_RATE_SAMPLE" : {
+        "unit" : "ms",
+        "fields" : {"sleep_respiratory_rate" : "RATE"}
+        },
+    "HUAMI_PAI_SAMPLE" : {
+        "unit" : "ms",
+        "fields" : {
+            "pai_low" : "PAI_LOW",
+            "pai_moderate" : "PAI_MODERATE",
+            "pai_high" : "PAI_HIGH",
+            "time_low" : "TIME_LOW",
+            "time_moderate" : "TIME_MODERATE",
+            "time_high" : "TIME_HIGH",
+            "pai_today" : "PAI_TODAY",
+            "pai_total" : "PAI_TOTAL"
+            }
+        },
+    "BATTERY_LEVEL" : {
+        "unit" : "s",
+        "tags" : {"battery" : "BATTERY_INDEX"},
+        "fields" : {"battery_level" : "LEVEL"}
+        },
+    # Heart rates are spread across tables, depending on the sampling types
+    "HUAMI_HEART_RATE_MANUAL_SAMPLE" : {
+        "unit" : "ms",
+        "static_tags" : {"sample_type" : "manual"},
+        "fields" : {"heart_rate" : "HEART_RATE"}
+        },
+    "HUAMI_HEART_RATE_MAX_SAMPLE" : {
+        "unit" : "ms",
+        "static_tags" : {"sample_type" : "max"},
+        "fields" : {"heart_rate" : "HEART_RATE"}
+        },
+    "HUAMI_HEART_RATE_RESTING_SAMPLE" : {
+        "unit" : "ms",
+        "static_tags" : {"sample_type" : "resting"},
+        "fields" : {"heart_rate" : "HEART_RATE"}
+        },
+    # Activity types are deliniated by the value of RAW_KIND
+    # but there isn't currently a reliable mapping for the
+    # meaning of each. There are also suggestions online that
+    # the meanings sometimes change between firmware revisions
+    #
+    # So, we'll just expose the value as a tag rather than attempting
+    # to map it to anything
+    "HUAMI_EXTENDED_ACTIVITY_SAMPLE" : {
+        "unit" : "s",
+        "tags" : {"activity_kind" : "RAW_KIND"},
+        "static_tags" : {"sample_type" : "activity"},
+        "fields" : {
+            "intensity" : "RAW_INTENSITY",
+            "steps" : "STEPS",
+            "heart_rate" : "HEART_RATE",
+            "sleep" : "SLEEP",
+            "deep_sleep" : "DEEP_SLEEP",
+            "rem_sleep" : "REM_SLEEP"
+            }
+        },
+    # Normal steps and HR measurements
+    "MI_BAND_ACTIVITY_SAMPLE" : {
+        "unit" : "s",
+        "static_tags" : {"sample_type" : "periodic_samples"},
+        "fields" : {
+            "intensity" : "RAW_INTENSITY",
+            "raw_intensity" : "RAW_INTENSITY",
+            "steps" : "STEPS",
+            "raw_kind" : "RAW_KIND",
+            "heart_rate" : "HEART_RATE"
+            }
+        },
+    # Sleep is derived from MI_BAND_ACTIVITY_SAMPLE, but is tracked
+    # separately because its marks are the last sleep sample seen
+    "sleep" : {
+        "table" : "MI_BAND_ACTIVITY_SAMPLE",
+        "unit" : "s",
+        "extractor" : extract_sleep,
+        "digest" : (("USER_ID", "RAW_INTENSITY", "RAW_KIND"), SLEEP_FILTER)
+        },
+    # Rollups start from the marks of the tasks they summarise, so
+    # don't have any of their own
+    "rollup_activity" : {
+        "table" : "MI_BAND_ACTIVITY_SAMPLE",
+        "extractor" : extract_activity_rollups
+        },
+    "rollup_stress" : {
+        "table" : "HUAMI_STRESS_SAMPLE",
+        "extractor" : extract_stress_rollups
+        },
+    "rollup_sleep" : {
+        "table" : "MI_BAND_ACTIVITY_SAMPLE",
+        "extractor" : extract_sleep_rollups
+        }
+    }
+
+TABLE_TIMESTAMP_UNITS = {task : TABLE_MAPPINGS[task]["unit"] for task in TABLE_MAPPINGS
+                         if "unit" in TABLE_MAPPINGS[task]}
+
+
+def timestamp_scale(task):
+    ''' Get the multiplier converting seconds into task's timestamp units
+    '''
+    return 1000 if TABLE_TIMESTAMP_UNITS[task] == "ms" else 1
+
+EXTRACTION_TASKS = {
+    task : TABLE_MAPPINGS[task].get("extractor", functools.partial(extract_table, task))
+    for task in TABLE_MAPPINGS
+    }
+
+
+def task_enabled(task):
+    ''' Check whether the config turns task on
+
+    Rollups need ROLLUPS, and sleep (including its rollup) needs the
+    SLEEP experimental option
+    '''
+    if task.startswith("rollup_") and ROLLUPS != "Y":
+        return False
+    if task in ("sleep", "rollup_sleep") and "SLEEP" not in EXPERIMENTAL_OPTS:
+        return False
+    return True
+
+
+def available_tasks(cur):
+    ''' Check which enabled tasks' tables exist in the database
+
+    Older exports may not have all of them
+    '''
+    tables = {r[0] for r in cur.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
+    tasks = []
+    for task in EXTRACTION_TASKS:
+        if not task_enabled(task):
+            continue
+        table = TABLE_MAPPINGS[task].get("table", task)
+        if table in tables:
+            tasks.append(task)
+        else:
+            print(f"Skipping {task}: table {table} not found")
+    return tasks
+
+
+class QueryWindow:
+    ''' Builds the WHERE clause for a table when called
+
+    start() gives the timestamp that a device's rows will start
+    from, for queries which need to look back beyond it. end() gives
+    the timestamp they stop before, if the window has an end
+
+    If device_id is given, only that device's rows are selected. users
+    holds the per-user marks, for tasks which record them
+    '''
+
+    def __init__(self, marks, start_bound, end_bound=None, device_id=None, users=None):
+        self.marks = marks
+        self.start_bound = start_bound
+        self.end_bound = end_bound
+        self.device_id = device_id
+        self.users = users or {}
+
+    def __call__(self, table):
+        predicate = timestamp_predicate(table, self.marks, self.start_bound, self.end_bound)
+        if self.device_id is None:
+            return predicate
+        return f"(DEVICE_ID = {int(self.device_id)} AND {predicate})"
+
+    def start(self, table, device_id):
+        return device_start(table, self.marks, self.start_bound, device_id)
+
+    def user_marks(self, table, device_id):
+        return self.users.get(table, {}).get(str(device_id), {})
+
+    def end(self, table):
+        if self.end_bound is None:
+            return None
+        scale = timestamp_scale(table)
+        return self.end_bound * scale
+
+
+def next_beyond(lead, table, outer, partition, condition, end):
+    ''' Extend a LEAD (TIMESTAMP) expression for windows with an end
+
+    The last row in the window has no next row within it, so is given
+    the timestamp of the first matching row (in the same partition)
+    beyond the end instead. The subquery is only evaluated for those rows
+    '''
+    if end is None:
+        return lead
+
+    matches = " AND ".join(f"n.{column} = {outer}.{column}" for column in partition)
+    return (f"COALESCE({lead}, (SELECT MIN(n.TIMESTAMP) FROM {table} n "
+            f"WHERE {matches} AND n.TIMESTAMP >= {end} AND {condition}))")
+
+
+def carry_query(table, columns, partition, condition, device_id, start, carry_from=None):
+    ''' Build a query selecting columns from the last row (where condition
+    holds) before start, for each of device_id's partitions
+
+    CARRY_FROM, set to start (or the SQL expression carry_from), is
+    added. Partitions without rows from start
+    on are skipped: a carried row would have no next row to run until.
+    Limiting the search to the others means each can be found by walking
+    back along the TIMESTAMP index rather than scanning the whole history
+    '''
+    keys = [key.strip() for key in partition.split(",")]
+    matches = " AND ".join(f"p.{key} = k.{key}" for key in keys)
+    latest = (f"SELECT p.TIMESTAMP FROM {table} p WHERE {matches} "
+        f"AND p.TIMESTAMP < {start} AND {condition} ORDER BY p.TIMESTAMP DESC LIMIT 1")
+
+    if carry_from is None:
+        carry_from = start
+    return (f"SELECT {', '.join(columns)}, {carry_from} AS CARRY_FROM FROM {table} "
+        f"WHERE DEVICE_ID = {int(device_id)} AND {condition} "
+        f"AND (TIMESTAMP, {partition}) IN ("
+        f"SELECT ({latest}), {', '.join('k.' + key for key in keys)} FROM ("
+        f"SELECT DISTINCT {partition} FROM {table} "
+        f"WHERE DEVICE_ID = {int(device_id)} AND TIMESTAMP >= {start} AND {condition}) k)")
+
+
+def make_window(state, start_bound):
+    ''' Return a QueryWindow based on the marks in state
+    '''
+    return QueryWindow(state.get("tables", {}), start_bound, users=state.get("users", {}))
+
+
+### Snapshot diffing
+#
+# Watches often sync samples hours or days late, and Gadgetbridge
+# sometimes rewrites existing rows. A window starting from the last run
+# misses those, so (if DIFF_SYNC is enabled) a digest of each hour of
+# each task's rows (within DIFF_LOOKBACK) is kept in the state. Hours
+# whose digest has changed are extracted again, on top of the usual window.
+
+DIGEST_PERIOD = 3600
+
+# Rows are hashed by a polynomial over their columns, modulo a prime so
+# that the arithmetic stays within SQLite's 64 bit integers
+DIGEST_MULTIPLIER = 1000003
+DIGEST_MODULUS = 2147483647
+# REAL columns are scaled by this before being made integers, so that
+# changes to their fractional part are picked up
+DIGEST_REAL_SCALE = 1000000
+
+
+def real_columns(cur, table):
+    ''' List the columns of table with REAL affinity
+    '''
+    columns = []
+    for r in cur.execute(f"PRAGMA table_info({table})").fetchall():
+        declared = r[2].upper()
+        if "INT" not in declared and any(name in declared for name in ("REAL", "FLOA", "DOUB")):
+            columns.append(r[1])
+    return columns
+
+
+def row_hash(columns, reals=()):
+    ''' Build an SQL expression hashing columns into a value below
+    DIGEST_MODULUS. Those in reals are scaled by DIGEST_REAL_SCALE first
+    '''
+    expression = f"(TIMESTAMP % {DIGEST_MODULUS})"
+    for column in columns:
+        value = f"IFNULL({column}, -1)"
+        if column in reals:
+            value = f"ROUND({value} * {DIGEST_REAL_SCALE})"
+        expression = (f"(({expression} * {DIGEST_MULTIPLIER} "
+            f"+ CAST({value} AS INTEGER)) % {DIGEST_MODULUS})")
+    return expression
+
+
+def digest_columns(cur, task):
+    ''' Work out which columns of task's table (and which rows) feed
+    its points
+    '''
+    mapping = TABLE_MAPPINGS[task]
+    if "digest" in mapping:
+        return mapping["digest"]
+
+    existing = table_columns(cur, mapping.get("table", task))
+    wanted = list(mapping.get("tags", {}).values()) + list(mapping["fields"].values())
+    columns = []
+    for column in wanted:
+        if column in existing and column not in columns:
+            columns.append(column)
+    return columns, "1"
+
+
+def table_digests(cur, task, start_hour):
+    ''' Digest each hour of task's rows, from start_hour on
+
+    Returns the digests keyed by device and then by hour (the number
+    of DIGEST_PERIODs since the epoch)
+    '''
+    mapping = TABLE_MAPPINGS[task]
+    table = mapping.get("table", task)
+    scale = timestamp_scale(task)
+    columns, condition = digest_columns(cur, task)
+
+    # Row hashes are summed rather than chained, so the order they're
+    # read in doesn't matter
+    digest_query = ("SELECT DEVICE_ID, TIMESTAMP / "
+        f"{DIGEST_PERIOD * scale} AS HOUR, COUNT(*), "
+        f"SUM({row_hash(columns, real_columns(cur, table))}) "
+        f"FROM {table} "
+        f"WHERE {condition} AND TIMESTAMP >= {start_hour * DIGEST_PERIOD * scale} "
+        "GROUP BY DEVICE_ID, HOUR")
+
+    digests = {}
+    for r in cur.execute(digest_query).fetchall():
+        digest = zlib.crc32(f"{r[2]}:{r[3]}".encode())
+        digests.setdefault(str(r[0]), {})[str(r[1])] = f"{digest:08x}"
+    return digests
+
+
+def changed_hours(previous, current, since):
+    ''' Compare a task's digests with those from the last run
+
+    Returns the new or changed hours for each device. Devices without
+    previous digests are skipped: their first run establishes them, as
+    are hours before since (which the last run didn't digest).
+    Rows that have been deleted can't be removed from InfluxDB, so
+    hours which have disappeared are ignored
+    '''
+    changes = {}
+    for device_id in current:
+        known = previous.get(device_id)
+        if known is None:
+            continue
+        hours = [int(hour) for hour in current[device_id]
+                 if int(hour) >= since and known.get(hour) != current[device_id][hour]]
+        if hours:
+            changes[device_id] = hours
+    return changes
+
+
+def diff_export(cur, tasks, state, digests):
+    ''' Digest each task's rows into digests, returning the hours
+    which have changed since the digests in state were taken
+
+    The changes are keyed by task and then by device. Only the hours
+    within DIFF_LOOKBACK are digested, so older digests are dropped
+    '''
+    start_hour = 0
+    if DIFF_LOOKBACK:
+        start_hour = (int(time.time()) - DIFF_LOOKBACK) // DIGEST_PERIOD
+
+    previous = state.get("digests", {})
+    since = max(start_hour, previous.get("from", 0))
+    digests["from"] = start_hour
+    digests["tasks"] = {}
+    changes = {}
+    for task in tasks:
+        if task not in TABLE_TIMESTAMP_UNITS:
+            continue
+        current = digests["tasks"][task] = table_digests(cur, task, start_hour)
+        task_changes = changed_hours(previous.get("tasks", {}).get(task, {}), current, since)
+        if task_changes:
+            changes[task] = task_changes
+            hours = sum(len(task_changes[device_id]) for device_id in task_changes)
+            print(f"Task {task}: {hours} hours changed since the last run")
+            METRICS.count("diff_changed_hours", hours)
+    return changes
+
+
+def hour_ranges(hours):
+    ''' Merge hours into a list of (start, end) ranges in seconds
+    '''
+    ranges = []
+    for hour in sorted(hours):
+        start = hour * DIGEST_PERIOD
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = start + DIGEST_PERIOD
+        else:
+            ranges.append([start, start + DIGEST_PERIOD])
+    return ranges
+
+
+def rewind_marks(window, changes):
+    ''' Copy window's marks, moving them back so that each device starts
+    from its earliest changed hour
+    '''
+    marks = {table : dict(window.marks[table]) for table in window.marks}
+    for table in changes:
+        scale = timestamp_scale(table)
+        for device_id in changes[table]:
+            earliest = min(changes[table][device_id]) * DIGEST_PERIOD * scale
+            if earliest < window.start(table, device_id):
+                # timestamp_predicate will take STATE_OVERLAP off again
+                marks.setdefault(table, {})[device_id] = earliest + STATE_OVERLAP * scale
+    return marks
+
+
+def task_windows(task, state, start_bound, changes):
+    ''' List the windows task should be extracted over
+
+    The first is the usual window. Each device's changed hours before
+    its usual start are then extracted by bounded windows covering just
+    that device. Rollups cover whole buckets, so instead start from the
+    earliest change
+    '''
+    window = make_window(state, start_bound)
+    if not changes:
+        return [window]
+
+    if task not in TABLE_TIMESTAMP_UNITS:
+        return [QueryWindow(rewind_marks(window, changes), start_bound)]
+
+    task_changes = changes.get(task, {})
+    if not task_changes:
+        return [window]
+
+    scale = timestamp_scale(task)
+    windows = [window]
+    for device_id in task_changes:
+        # Hours from here on are covered by the device's usual window
+        covered = window.start(task, device_id) // scale
+        for start, end in hour_ranges(task_changes[device_id]):
+            end = min(end, covered)
+            if start < end:
+                windows.append(QueryWindow({}, start, end, int(device_id)))
+    return windows
+
+
+def extract_task(task, cur, devices, windows, marks):
+    ''' Run task over each of windows in turn
+
+    Only the first is the usual window, the others cover hours which
+    changed before it, so the marks that they reach aren't recorded
+    '''
+    for window in windows:
+        window_devices = devices
+        if window.device_id is not None:
+            if window.device_id not in devices:
+                continue
+            window_devices = {window.device_id : devices[window.device_id]}
+        yield from EXTRACTION_TASKS[task](cur, window_devices, window, marks)
+        marks = {}
+
+
+def extract_data(cur, devices, state=None, progress=None, connect=None, digests=None):
+    ''' Query the database for data
+
+    This is a generator: rows are yielded as they're read from
+    the database so that they can be written onwards without
+    the full result set being held in memory
+
+    If state is provided, queries start from the high-water marks
+    recorded by the last run rather than QUERY_DURATION ago. The
+    latest timestamp seen for each table and device is recorded into
+    progress, so that it can be persisted once the write has completed
+
+    If EXTRACT_WORKERS is more than 1, connect must be a function
+    returning a new (read-only) connection to the database. Each
+    worker will use its own.
+
+    If digests is provided, each table is digested into it, and hours
+    which have changed since the digests in state were taken are
+    extracted too
+    '''
+    if state is None:
+        state = {}
+    if progress is None:
+        progress = {}
+
+    query_start_bound = int(time.time()) - QUERY_DURATION
+    tasks = available_tasks(cur)
+
+    changes = {}
+    if digests is not None:
+        with METRICS.timer("diff"):
+            changes = diff_export(cur, tasks, state, digests)
+
+    if EXTRACT_WORKERS > 1 and connect is not None:
+        yield from extract_parallel(connect, tasks, devices, state, query_start_bound, progress, changes)
+    else:
+        for task in tasks:
+            marks = progress.setdefault(task, {}) if task in TABLE_TIMESTAMP_UNITS else {}
+            windows = task_windows(task, state, query_start_bound, changes)
+            yield from timed_task(task, extract_task(task, cur, devices, windows, marks))
+
+    # Create a field to record when we last synced, based on the most recent
+    # timestamp seen for each device
+    now = time.time_ns()
+    devices_observed = last_seen(progress)
+    for device_id in devices_observed:
+        row_ts = devices_observed[device_id]
+        row_age = now - row_ts
+        yield make_record(now, "ns",
+            {"device" : devices[device_id], "sample_type" : "sync_check"},
+            {"last_seen" : row_ts, "last_seen_age" : row_age}
+            )
+
+
+def run_extraction_task(task, connect, devices, state, start_bound, changes, out_queue, cancel):
+    ''' Run a single extraction task on its own connection, serializing
+    its output into LineBatches which are pushed onto out_queue
+
+    Finishes by pushing the high-water marks reached (and the task's
+    metrics), so that they can be merged into the run's progress. If
+    cancel is set, the task stops at the next batch
+    '''
+    marks = {}
+    try:
+        conn = connect()
+        batches = {}
+        windows = task_windows(task, state, start_bound, changes)
+        stats = METRICS.task_stats(task)
+        rows = timed_task(task, extract_task(task, conn.cursor(), devices, windows, marks))
+        for row in rows:
+            if type(row) is not LineBatch:
+                start = time.perf_counter()
+                line = serialize_row(row)
+                stats["serialize_seconds"] += time.perf_counter() - start
+                if line is None:
+                    continue
+                batch = batches.get(row.precision)
+                if batch is None:
+                    batch = batches[row.precision] = []
+                batch.append(line)
+                if len(batch) < QUERY_FETCH_SIZE:
+                    continue
+                row = LineBatch(row.precision, batch)
+                batches[row.precision] = []
+
+            if cancel.is_set():
+                break
+            out_queue.put(row)
+
+        else:
+            for precision in batches:
+                if batches[precision]:
+                    out_queue.put(LineBatch(precision, batches[precision]))
+        conn.close()
+    finally:
+        # Always signal completion, otherwise the consumer would wait forever
+        #
+        # The task's stats are handed back rather than left in METRICS
+        # because a process pool won't share it with us
+        out_queue.put((task, marks, METRICS.tasks.pop(task, {})))
+
+
+def extract_parallel(connect, tasks, devices, state, start_bound, progress, changes=None):
+    ''' Run the extraction tasks on a pool of EXTRACT_WORKERS, yielding
+    their output as it arrives
+    '''
+    if EXTRACT_POOL == "process":
+        manager = multiprocessing.Manager()
+        out_queue = manager.Queue(EXTRACT_QUEUE_SIZE)
+        cancel = manager.Event()
+        pool = concurrent.futures.ProcessPoolExecutor(EXTRACT_WORKERS)
+    else:
+        manager = None
+        out_queue = queue.Queue(EXTRACT_QUEUE_SIZE)
+        cancel = threading.Event()
+        pool = concurrent.futures.ThreadPoolExecutor(EXTRACT_WORKERS)
+
+    remaining = len(tasks)
+    try:
+        with pool:
+            futures = [pool.submit(run_extraction_task, task, connect, devices, state,
+                                   start_bound, changes or {}, out_queue, cancel)
+                       for task in tasks]
+            try:
+                while remaining:
+                    item = out_queue.get()
+                    if type(item) is LineBatch:
+                        yield item
+                        continue
+
+                    # A task has finished
+                    task, marks, stats = item
+                    METRICS.merge_task(task, stats)
+                    if task in TABLE_TIMESTAMP_UNITS:
+                        progress[task] = marks
+                    remaining -= 1
+            finally:
+                if remaining:
+                    # We're bailing out early (probably because the write failed)
+                    # tell the workers to stop and drain the queue so that
+                    # none are left blocked
+                    cancel.set()
+                    while remaining:
+                        if type(out_queue.get()) is not LineBatch:
+                            remaining -= 1
+
+            # Surface any exception raised by a worker
+            for future in futures:
+                future.result()
+    finally:
+        if manager is not None:
+            manager.shutdown()
+
+
+def get_sleep_data(cur, devices, window, marks):
+    ''' Attempt to fetch sleep data and calculate periods
+    '''
+    if "SLEEP" not in EXPERIMENTAL_OPTS:
+        return
+
+    print("Experimental: Sleep Data")
+
+    # A sleep phase lasts until the next sleep sample, so the last
+    # sample before the window is carried in for each device and user.
+    # That way the phase that was in progress when the window opens is
+    # still expanded. CARRY_FROM is the timestamp its minutes are expanded
+    # from: the user's last exported sample if we know it (the window
+    # starts from the device's mark, which another user may be well past),
+    # otherwise the timestamp the window opens at. It's NULL for rows
+    # inside the window
+    carried = []
+    for device_id in devices:
+        start = window.start("sleep", device_id)
+        users = window.user_marks("sleep", device_id)
+        carry_from = None
+        if users:
+            carry_from = ("CASE USER_ID "
+                + "".join(f"WHEN {int(user_id)} THEN {int(users[user_id])} " for user_id in users)
+                + f"ELSE {start} END")
+        carried.append(" UNION ALL " + carry_query("MI_BAND_ACTIVITY_SAMPLE",
+            ("TIMESTAMP", "DEVICE_ID", "USER_ID", "RAW_INTENSITY", "RAW_KIND"),
+            "DEVICE_ID, USER_ID", SLEEP_FILTER, device_id, start, carry_from))
+
+    # If the window has an end, the last phase in it runs until the first
+    # sample beyond. Its minutes are only expanded up to the end though,
+    # the rest are expanded (as a carried in row) by the following window
+    end = window.end("sleep")
+    next_ts = next_beyond(
+        "LEAD (TIMESTAMP, 1) OVER (PARTITION BY DEVICE_ID, USER_ID ORDER BY TIMESTAMP)",
+        "MI_BAND_ACTIVITY_SAMPLE", "samples", ("DEVICE_ID", "USER_ID"), SLEEP_FILTER, end
+        )
+
+    # Capture sleep data
+    # utilities/gadgetbridge_to_influxdb#14
+    data_query = ("SELECT TIMESTAMP, DEVICE_ID, RAW_INTENSITY, RAW_KIND, "
+    f"{next_ts} NEXT_TS, "
+    "LEAD (RAW_KIND, 1) OVER (PARTITION BY DEVICE_ID, USER_ID ORDER BY TIMESTAMP) NEXT_KIND, "
+    "CARRY_FROM, USER_ID "
+    "FROM ("
+    "SELECT TIMESTAMP, DEVICE_ID, USER_ID, RAW_INTENSITY, RAW_KIND, NULL AS CARRY_FROM "
+    "FROM MI_BAND_ACTIVITY_SAMPLE "
+    f"WHERE {SLEEP_FILTER} AND {window('sleep')}"
+    f"{''.join(carried)}) samples "
+    "ORDER BY TIMESTAMP "
+    )
+
+    sparse = "sleep" in SPARSE_SERIES
+    if column_engine_enabled() and not sparse:
+        templates = LineTemplates()
+        for rows in iter_query_chunks(cur, data_query):
+            for r in rows:
+                if r[6] is None:
+                    marks[r[1]] = r[0]
+                    marks[(r[1], r[7])] = r[0]
+            yield LineBatch("s", expand_sleep_lines(rows, devices, templates, end))
+        return
+
+    for r in iter_query(cur, data_query):
+        sleep_type = SLEEP_KINDS[r[3]]
+        sleep_start = r[0]
+        if r[6] is None:
+            marks[r[1]] = r[0]
+            marks[(r[1], r[7])] = r[0]
+            fields = {"intensity" : r[2], f"{sleep_type}_sleep" : 1}
+            if sparse:
+                # The state change stands in for the per-minute points
+                fields["sleep_stage"] = sleep_type
+                if r[4]:
+                    fields["duration"] = r[4] - r[0]
+            yield make_record(r[0], "s",
+                {"device" : devices[r[1]], "sample_type" : "sleep", "sleep" : "state-change"},
+                fields
+                )
+        elif sparse:
+            continue
+        elif r[6] > r[0]:
+            # Carried in: the state change and the minutes before
+            # CARRY_FROM have already been exported
+            sleep_start += -((r[0] - r[6]) // 60) * 60
+
+        # Generate the per-minute stats
+        if r[4] and sleep_type not in ["waking"] and not sparse:
+            point = make_record(None, "s",
+                {"device" : devices[r[1]], "sample_type" : "sleep", "sleep" : "point-in-time"},
+                {"intensity" : r[2], f"{sleep_type}_sleep" : 1, "sleep_stage" : sleep_type}
+                )
+
+            sleep_end = r[4] if end is None else min(r[4], end)
+            while sleep_start < sleep_end:
+                yield Record(sleep_start, "s", point.tags, point.names, point.values)
+                sleep_start += 60
+
+
+### Columnar expansion engine
+#
+# Stress and sleep samples are expanded into a point per minute. Doing that
+# a row at a time means building a dict (and checking the hour) for every
+# generated point. If NumPy is available, a whole chunk of samples is
+# expanded at once and the lines are rendered from templates instead.
+#
+# The output is identical to that of the row-at-a-time path
+
+# Counter fields for each stress level, in the order returned by classify_stress
+STRESS_LEVELS = [
+    "stress_level_counter_relaxed",
+    "stress_level_counter_normal",
+    "stress_level_counter_medium",
+    "stress_level_counter_high",
+    "stress_level_counter_unknown"
+    ]
+
+def column_engine_enabled():
+    ''' Should the columnar engine be used?
+    '''
+    global numpy
+    if EXPANSION_ENGINE == "python":
+        return False
+
+    if numpy is None:
+        try:
+            numpy = lazy_import("numpy")
+        except ImportError:
+            numpy = False
+    return numpy is not False
+
+
+class LineBatch:
+    ''' A run of pre-serialized lines, all sharing a precision
+    '''
+    __slots__ = ("precision", "lines")
+
+    def __init__(self, precision, lines):
+        self.precision = precision
+        self.lines = lines
+
+
+class LineTemplates:
+    ''' Serialized lines, minus their timestamp, for points which
+    only differ by timestamp
+    '''
+
+    def __init__(self):
+        self.prefixes = []
+        self.index = {}
+
+    def get(self, key, build):
+        ''' Return the template ID for key, calling build() to create the
+        row if it hasn't been seen before
+
+        Returns -1 if the row has nothing to write
+        '''
+        template_id = self.index.get(key)
+        if template_id is None:
+            line = serialize_row(build())
+            if line is None:
+                template_id = -1
+            else:
+                template_id = len(self.prefixes)
+                self.prefixes.append(line)
+            self.index[key] = template_id
+        return template_id
+
+    def render(self, template_ids, timestamps):
+        ''' Render lines from arrays of template IDs and timestamps
+        '''
+        keep = template_ids >= 0
+        prefixes = self.prefixes
+        return [prefixes[i] + str(ts) for i, ts in
+                zip(template_ids[keep].tolist(), timestamps[keep].tolist())]
+
+
+def sleep_hour_lookup():
+    ''' Build a 24 entry array indicating which hours are sleeping hours
+    '''
+    return numpy.array([str(hour) in SLEEP_HOURS for hour in range(24)])
+
+
+def expand_intervals(starts, ends, step):
+    ''' Expand each interval into its start point followed by a point
+    every step until (but excluding) the end
+
+    Intervals with no end only produce the start point. Returns the
+    timestamps, the index of the interval each belongs to and a mask
+    indicating which are start points
+    '''
+    counts = numpy.where(ends > starts, (ends - starts + step - 1) // step, 0)
+    totals = counts + 1
+    firsts = numpy.cumsum(totals) - totals
+    source = numpy.repeat(numpy.arange(len(starts)), totals)
+    position = numpy.arange(int(totals.sum())) - firsts[source]
+
+    # The start point and the first generated point share a timestamp
+    timestamps = starts[source] + numpy.maximum(position - 1, 0) * step
+    return timestamps, source, position == 0
+
+
+def classify_stress(values):
+    ''' Map stress values onto indexes into STRESS_LEVELS
+
+    these thresholds were taken from the Zepp app
+    '''
+    return numpy.select(
+        [values <= 39,
+         (values >= 40) & (values <= 59),
+         (values >= 60) & (values <= 79),
+         values >= 80],
+        [0, 1, 2, 3], 4)
+
+
+def expand_stress_lines(rows, devices, templates):
+    ''' Render a chunk of HUAMI_STRESS_SAMPLE rows (with NEXT_TS) into
+    line protocol, including the per-minute points
+
+    Rows carried in from before the window (with CARRY_FROM set) only
+    contribute their per-minute points
+    '''
+    starts = numpy.array([r[0] for r in rows], dtype=numpy.int64)
+    # A missing NEXT_TS means there's nothing to expand
+    ends = numpy.array([r[4] or 0 for r in rows], dtype=numpy.int64)
+    levels = classify_stress(numpy.array([r[3] for r in rows], dtype=numpy.int64)).tolist()
+    sleeping = sleep_hour_lookup()
+
+    # Each row needs four templates: the sample itself and the
+    # per-minute points, each inside and outside of sleeping hours
+    template_ids = numpy.empty((len(rows), 2, 2), dtype=numpy.int64)
+    for i, r in enumerate(rows):
+        device = devices[r[1]]
+        stress_level = STRESS_LEVELS[levels[i]]
+        for awake in (0, 1):
+            def build_sample():
+                fields = {"stress" : r[3]}
+                if awake:
+                    fields["stress_exc_sleep"] = r[3]
+                return make_record("", "ms", {"type_num" : r[2], "device" : device}, fields)
+
+            def build_point():
+                fields = {"current_stress_level" : r[3], stress_level : 1}
+                if awake:
+                    fields[f"{stress_level}_exc_sleep"] = 1
+                return make_record("", "ms",
+                    {"type_num" : r[2], "device" : device, "stress" : "point_in_time"},
+                    fields
+                    )
+
+            template_ids[i, 0, awake] = templates.get(("sample", r[1], r[2], r[3], awake), build_sample)
+            template_ids[i, 1, awake] = templates.get(("point", r[1], r[2], r[3], awake), build_point)
+
+    timestamps, source, is_sample = expand_intervals(starts, ends, 60000)
+    carried = numpy.array([r[5] is not None for r in rows], dtype=bool)
+    keep = ~(is_sample & carried[source])
+    timestamps = timestamps[keep]
+    source = source[keep]
+    is_sample = is_sample[keep]
+    awake = (~sleeping[(timestamps // 3600000) % 24]).astype(numpy.int64)
+    ids = template_ids[source, (~is_sample).astype(numpy.int64), awake]
+    return templates.render(ids, timestamps)
+
+
+def expand_sleep_lines(rows, devices, templates, end=None):
+    ''' Render a chunk of sleep rows from MI_BAND_ACTIVITY_SAMPLE (with
+    NEXT_TS) into line protocol, including the per-minute points
+
+    Rows carried in from before the window only contribute the
+    points from CARRY_FROM onwards, and not their state change. If end
+    is given, no points are generated from then on
+    '''
+    starts = numpy.array([r[0] for r in rows], dtype=numpy.int64)
+    ends = numpy.array([(r[4] or 0) if SLEEP_KINDS[r[3]] != "waking" else 0 for r in rows],
+                       dtype=numpy.int64)
+    if end is not None:
+        ends = numpy.minimum(ends, end)
+    floors = numpy.array([r[0] if r[6] is None else r[6] for r in rows], dtype=numpy.int64)
+
+    template_ids = numpy.empty((len(rows), 2), dtype=numpy.int64)
+    for i, r in enumerate(rows):
+        device = devices[r[1]]
+        sleep_type = SLEEP_KINDS[r[3]]
+
+        def build_change():
+            return make_record("", "s",
+                {"device" : device, "sample_type" : "sleep", "sleep" : "state-change"},
+                {"intensity" : r[2], f"{sleep_type}_sleep" : 1}
+                )
+
+        def build_point():
+            return make_record("", "s",
+                {"device" : device, "sample_type" : "sleep", "sleep" : "point-in-time"},
+                {"intensity" : r[2], f"{sleep_type}_sleep" : 1, "sleep_stage" : sleep_type}
+                )
+
+        template_ids[i, 0] = templates.get(("change", r[1], r[2], r[3]), build_change)
+        template_ids[i, 1] = templates.get(("point", r[1], r[2], r[3]), build_point)
+
+    timestamps, source, is_change = expand_intervals(starts, ends, 60)
+    carried = numpy.array([r[6] is not None for r in rows], dtype=bool)
+    keep = (timestamps >= floors[source]) & ~(is_change & carried[source])
+    timestamps = timestamps[keep]
+    source = source[keep]
+    ids = template_ids[source, (~is_change[keep]).astype(numpy.int64)]
+    return templates.render(ids, timestamps)
+
+
+# Line protocol escaping, as per
+# https://docs.influxdata.com/influxdb/v2/reference/syntax/line-protocol/#special-characters
+ESCAPE_MEASUREMENT = str.maketrans({
+    ',': r'\,',
+    ' ': r'\ ',
+    '\n': r'\n',
+    '\t': r'\t',
+    '\r': r'\r',
+    })
+
+ESCAPE_KEY = str.maketrans({
+    ',': r'\,',
+    '=': r'\=',
+    ' ': r'\ ',
+    '\n': r'\n',
+    '\t': r'\t',
+    '\r': r'\r',
+    })
+
+ESCAPE_STRING = str.maketrans({
+    '"': r'\"',
+    '\\': r'\\',
+    })
+
+
+def format_field_value(value):
+    ''' Render a field value in line protocol form
+
+    Returns None if the value can't be represented
+    '''
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return None
+        s = str(value)
+        # Whole numbers don't need the trailing .0
+        if s.endswith(".0"):
+            s = s[:-2]
+        return s
+    return '"' + str(value).translate(ESCAPE_STRING) + '"'
+
+
+# Tagsets and keys repeat constantly, so their escaped forms are cached
+TAGSET_CACHE = {}
+KEY_CACHE = {}
+
+
+def escape_key(key):
+    ''' Escape a tag or field key
+    '''
+    escaped = KEY_CACHE.get(key)
+    if escaped is None:
+        escaped = KEY_CACHE[key] = str(key).translate(ESCAPE_KEY)
+    return escaped
+
+
+def escape_measurement(measurement):
+    ''' Escape a measurement name
+    '''
+    escaped = KEY_CACHE.get(("measurement", measurement))
+    if escaped is None:
+        escaped = KEY_CACHE[("measurement", measurement)] = measurement.translate(ESCAPE_MEASUREMENT)
+    return escaped
+
+
+def serialize_tags(tags):
+    ''' Render a (sorted) tuple of tags into a tagset, including
+    the leading comma
+    '''
+    tagset = TAGSET_CACHE.get(tags)
+    if tagset is not None:
+        return tagset
+
+    tagset = []
+    for tag, value in tags:
+        if value is None:
+            continue
+        key = escape_key(tag)
+        value = str(value).translate(ESCAPE_KEY)
+        if value.endswith("\\"):
+            value += " "
+        if key and value:
+            tagset.append(f"{key}={value}")
+
+    rendered = "," + ",".join(tagset) if tagset else ""
+    TAGSET_CACHE[tags] = rendered
+    return rendered
+
+
+def serialize_row(row, measurement=None):
+    ''' Convert a Record into a line of line protocol
+
+    measurement defaults to INFLUXDB_MEASUREMENT. Returns None if the
+    row has no writable fields
+    '''
+    if measurement is None:
+        measurement = INFLUXDB_MEASUREMENT
+
+    fieldset = []
+    for field, value in zip(row.names, row.values):
+        if value is None or value == -1:
+            continue
+
+        # Skip any special heart_rate values
+        # utilities/gadgetbridge_to_influxdb#1
+        if field == "heart_rate" and value > 253:
+            continue
+
+        if type(value) is int:
+            fieldset.append(f"{escape_key(field)}={value}i")
+            continue
+
+        value = format_field_value(value)
+        if value is not None:
+            fieldset.append(f"{escape_key(field)}={value}")
+
+    if not fieldset:
+        return None
+
+    return (f"{escape_measurement(measurement)}{serialize_tags(row.tags)} "
+            f"{','.join(fieldset)} {row.timestamp}")
+
+
+class LineProtocolWriter:
+    ''' Accumulate pre-serialized lines and write them into InfluxDB
+    in batches.
+
+    The write API only accepts a single precision per request, so a
+    buffer is kept per precision.
+    '''
+
+    def __init__(self, write_api, bucket=None, org=None,
+                 batch_size=INFLUXDB_BATCH_SIZE, flush_interval=INFLUXDB_FLUSH_INTERVAL):
+        self.write_api = write_api
+        # Resolved now, rather than at import, so that tenants can set them
+        self.bucket = bucket if bucket is not None else INFLUXDB_BUCKET
+        self.org = org if org is not None else INFLUXDB_ORG
+        self.batch_size = batch_size
+        # Convert to seconds
+        self.flush_interval = flush_interval / 1000
+        self.buffers = {}
+        self.last_flush = time.monotonic()
+        self.lines_written = 0
+
+    def add(self, line, precision):
+        ''' Queue a line for writing, flushing if necessary
+        '''
+        buf = self.buffers.get(precision)
+        if buf is None:
+            buf = self.buffers[precision] = []
+        buf.append(line)
+
+        if len(buf) >= self.batch_size:
+            self._write(precision)
+        elif time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def add_lines(self, lines, precision):
+        ''' Queue a list of lines for writing
+        '''
+        buf = self.buffers.get(precision)
+        if buf is None:
+            buf = self.buffers[precision] = []
+
+        while lines:
+            space = self.batch_size - len(buf)
+            buf.extend(lines[:space])
+            lines = lines[space:]
+            if len(buf) >= self.batch_size:
+                self._write(precision)
+                buf = self.buffers[precision]
+
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        ''' Write out everything that's currently buffered
+        '''
+        for precision in self.buffers:
+            if self.buffers[precision]:
+                self._write(precision)
+        self.last_flush = time.monotonic()
+
+    def _write(self, precision):
+        lines = self.buffers[precision]
+        self.buffers[precision] = []
+        start = time.perf_counter()
+        try:
+            self.write_api.write(self.bucket, self.org, record="\n".join(lines), write_precision=precision)
+        except Exception:
+            METRICS.count("write_failures")
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            METRICS.add_time("write", duration)
+            METRICS.peak("write_batch_max_seconds", duration)
+            METRICS.count("write_batches")
+        self.lines_written += len(lines)
+
+
+class SpoolWriteAPI:
+    ''' Stands in for the InfluxDB write API, appending each batch to
+    a spool on disk. A background thread sends them on to InfluxDB
+
+    Each batch is a gzipped file holding a JSON header (bucket, org and
+    precision) followed by the line protocol. Files are named so that
+    they sort in the order they were written, and are only removed once
+    InfluxDB has accepted them. Any left over by a previous run are sent
+    first.
+    '''
+
+    def __init__(self, write_api, directory=None, max_size=None):
+        self.write_api = write_api
+        self.directory = directory if directory is not None else SPOOL_DIR
+        self.max_size = max_size if max_size is not None else SPOOL_MAX_SIZE
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.cond = threading.Condition()
+        self.sequence = itertools.count()
+        self.closing = False
+        self.abandon = False
+        self.segments = sorted(f for f in os.listdir(self.directory) if f.endswith(".lp.gz"))
+        self.sizes = {f : os.path.getsize(f"{self.directory}/{f}") for f in self.segments}
+        self.size = sum(self.sizes.values())
+        if self.segments:
+            print(f"Replaying {len(self.segments)} spooled batches")
+
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def write(self, bucket, org, record, write_precision):
+        header = json.dumps({"bucket" : bucket, "org" : org, "precision" : write_precision})
+        data = gzip.compress(f"{header}\n{record}".encode("utf-8"), compresslevel=1)
+
+        # Apply backpressure: wait for the spool to drain if this
+        # wouldn't fit
+        with self.cond:
+            deadline = time.monotonic() + SPOOL_FULL_TIMEOUT
+            while self.size and self.size + len(data) > self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RuntimeError("Write spool is full")
+                METRICS.count("spool_full_waits")
+                self.cond.wait(remaining)
+
+        name = f"{time.time_ns()}-{os.getpid()}-{next(self.sequence):06d}.lp.gz"
+        path = f"{self.directory}/{name}"
+        with open(f"{path}.part", "wb") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(f"{path}.part", path)
+        METRICS.count("spool_bytes", len(data))
+
+        with self.cond:
+            self.segments.append(name)
+            self.sizes[name] = len(data)
+            self.size += len(data)
+            self.cond.notify_all()
+
+    def _drain(self):
+        ''' Send spooled batches, oldest first, until closed
+        '''
+        failures = 0
+        while True:
+            with self.cond:
+                while not self.segments and not self.closing:
+                    self.cond.wait()
+                if not self.segments or self.abandon:
+                    return
+                name = self.segments[0]
+
+            path = f"{self.directory}/{name}"
+            try:
+                with gzip.open(path, "rt", encoding="utf-8") as fh:
+                    header = json.loads(fh.readline())
+                    record = fh.read()
+            except FileNotFoundError:
+                # Another process has already sent it
+                self._remove(name)
+                continue
+
+            start = time.perf_counter()
+            try:
+                self.write_api.write(header["bucket"], header["org"], record=record,
+                                     write_precision=header["precision"])
+            except Exception as e:
+                if getattr(e, "status", None) in (400, 413, 422):
+                    # Retrying won't help, set it aside so that the
+                    # rest of the spool isn't held up
+                    print(f"Error: InfluxDB rejected spooled batch {name}, moved aside: {e}")
+                    METRICS.count("spool_rejected")
+                    os.replace(path, f"{path}.rejected")
+                    self._remove(name)
+                    continue
+
+                failures += 1
+                METRICS.count("spool_retries")
+                delay = min(SPOOL_RETRY_MAX, SPOOL_RETRY_MIN * 2 ** (failures - 1))
+                delay *= random.uniform(0.5, 1)
+                print(f"Spooled write failed ({e}), retrying in {delay:.1f}s")
+                retry_at = time.monotonic() + delay
+                with self.cond:
+                    # New batches wake us too, so keep waiting
+                    while not self.abandon and time.monotonic() < retry_at:
+                        self.cond.wait(retry_at - time.monotonic())
+                continue
+            finally:
+                # This happens in the background, so isn't a stage
+                METRICS.count("spool_send_seconds", time.perf_counter() - start)
+
+            failures = 0
+            METRICS.count("spool_batches_sent")
+            os.unlink(path)
+            self._remove(name)
+
+    def _remove(self, name):
+        with self.cond:
+            self.segments.remove(name)
+            self.size -= self.sizes.pop(name)
+            self.cond.notify_all()
+
+    def close(self, timeout=None):
+        ''' Wait (for up to timeout seconds) for the spool to drain
+
+        Anything not sent by then stays in the spool for the next run
+        '''
+        timeout = timeout if timeout is not None else SPOOL_DRAIN_TIMEOUT
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            with self.cond:
+                self.abandon = True
+                self.cond.notify_all()
+            self.thread.join()
+
+        if self.segments:
+            print(f"{len(self.segments)} batches left in spool, they'll be sent by the next run")
+
+
+class UrllibWriteAPI:
+    ''' Stands in for the InfluxDB write API, posting each batch
+    directly with urllib
+
+    For runs with only a handful of points to write (an unchanged
+    export, self-monitoring), where importing the InfluxDB client
+    would take longer than the write itself
+    '''
+
+    def write(self, bucket, org, record, write_precision):
+        query = urllib.parse.urlencode({"bucket" : bucket, "org" : org, "precision" : write_precision})
+        body = record.encode("utf-8")
+        headers = {
+            "Authorization" : f"Token {INFLUXDB_TOKEN}",
+            "Content-Type" : "text/plain; charset=utf-8"
+            }
+        if INFLUXDB_GZIP == "Y":
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+
+        request = urllib.request.Request(f"{INFLUXDB_URL.rstrip('/')}/api/v2/write?{query}",
+                                         data=body, headers=headers, method="POST")
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+
+
+def open_influxdb():
+    ''' Create an InfluxDB client
+    '''
+    return lazy_import("influxdb_client").InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN,
+        org=INFLUXDB_ORG, enable_gzip=(INFLUXDB_GZIP == "Y"))
+
+
+def open_sync_write_api(client):
+    ''' Get a synchronous write API from an InfluxDB client
+    '''
+    write_options = lazy_import("influxdb_client.client.write_api").SYNCHRONOUS
+    return client.write_api(write_options=write_options)
+
+
+@contextlib.contextmanager
+def open_write_api():
+    ''' Connect to InfluxDB and yield a write API
+
+    If SPOOL_DIR is set, writes go via the spool, which is given
+    SPOOL_DRAIN_TIMEOUT seconds to drain before the connection closes
+    '''
+    with open_influxdb() as _client:
+        with open_sync_write_api(_client) as write_api:
+            if not SPOOL_DIR:
+                yield write_api
+                return
+
+            spool = SpoolWriteAPI(write_api)
+            try:
+                yield spool
+            finally:
+                spool.close()
+
+
+def write_results(results, measurement=None, write_api=None):
+    ''' Write the results into InfluxDB
+
+    results can be any iterable of rows (including a generator), it's
+    consumed as it's written. Returns the number of points written
+
+    If write_api isn't provided, a connection is opened for the write
+    '''
+    if write_api is None:
+        with open_write_api() as _write_client:
+            return write_results(results, measurement, _write_client)
+
+    serialize_time = 0.0
+    writer = LineProtocolWriter(write_api)
+    for row in results:
+        if type(row) is LineBatch:
+            writer.add_lines(row.lines, row.precision)
+            continue
+        start = time.perf_counter()
+        line = serialize_row(row, measurement)
+        serialize_time += time.perf_counter() - start
+        if line:
+            writer.add(line, row.precision)
+    writer.flush()
+
+    METRICS.add_time("serialize", serialize_time)
+    METRICS.count("points_written", writer.lines_written)
+    print(f"Wrote {writer.lines_written} points")
+    return writer.lines_written
+
+
+### Self monitoring
+#
+# Timings and counters for each stage of the run, written out at
+# the end so that the pipeline's own performance can be charted
+
+class RunMetrics:
+    ''' Timings (in seconds) and counters for the current run
+
+    Per-task stats are keyed by extraction task, queries are
+    attributed to whichever task the current thread is running
+    '''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.tasks = {}
+        self.current = threading.local()
+
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def peak(self, name, value):
+        if value > self.counters.get(name, 0):
+            self.counters[name] = value
+
+    def task_stats(self, task=None):
+        ''' Return the stats for task, or for the task that the
+        current thread is running
+        '''
+        if task is None:
+            task = getattr(self.current, "task", "other")
+        stats = self.tasks.get(task)
+        if stats is None:
+            stats = self.tasks[task] = {
+                "queries" : 0,
+                "query_seconds" : 0.0,
+                "rows" : 0,
+                "points" : 0,
+                "seconds" : 0.0,
+                "serialize_seconds" : 0.0
+                }
+        return stats
+
+    def merge_task(self, task, stats):
+        ''' Fold in stats collected elsewhere (e.g. by a worker process)
+        '''
+        mine = self.task_stats(task)
+        for key in stats:
+            mine[key] += stats[key]
+
+    def stage_times(self):
+        ''' Calculate the time spent in each stage
+
+        Query time is split out of the time spent in each extraction
+        task, the remainder being row conversion (or, for sleep,
+        expansion)
+        '''
+        stages = dict(self.stages)
+        for task in self.tasks:
+            stats = self.tasks[task]
+            stage = "sleep" if task == "sleep" else "convert"
+            stages["query"] = stages.get("query", 0.0) + stats["query_seconds"]
+            stages[stage] = stages.get(stage, 0.0) + stats["seconds"] - stats["query_seconds"]
+            stages["serialize"] = stages.get("serialize", 0.0) + stats["serialize_seconds"]
+        return stages
+
+
+METRICS = RunMetrics()
+
+
+def timed_task(task, rows):
+    ''' Wrap an extraction task's generator, recording the time spent
+    in it and the number of points it produces
+    '''
+    METRICS.current.task = task
+    stats = METRICS.task_stats(task)
+    start = time.perf_counter()
+    for row in rows:
+        stats["seconds"] += time.perf_counter() - start
+        stats["points"] += len(row.lines) if type(row) is LineBatch else 1
+        yield row
+        start = time.perf_counter()
+    stats["seconds"] += time.perf_counter() - start
+
+
+def metrics_records():
+    ''' Build the self-monitoring points for the run
+
+    The overhead is the time not accounted for by any stage. If
+    extraction runs in parallel, stages overlap and it can be negative
+    '''
+    now = time.time_ns()
+    elapsed = time.perf_counter() - METRICS.started
+    stages = METRICS.stage_times()
+    tags = {"tenant" : TENANT_NAME} if TENANT_NAME else {}
+
+    fields = {f"{stage}_seconds" : stages[stage] for stage in stages}
+    fields.update(METRICS.counters)
+    fields["rows_read"] = sum(METRICS.tasks[task]["rows"] for task in METRICS.tasks)
+    fields["total_seconds"] = elapsed
+    fields["overhead_seconds"] = elapsed - sum(stages.values())
+    records = [make_record(now, "ns", {"sample_type" : "run", **tags}, fields)]
+
+    for task in METRICS.tasks:
+        records.append(make_record(now, "ns", {"sample_type" : "task", "task" : task, **tags},
+                                   METRICS.tasks[task]))
+    return records
+
+
+def format_metrics(records):
+    ''' Render the self-monitoring points in Prometheus text format
+    '''
+    # Samples need to be grouped by metric
+    families = {"gadgetbridge_to_influxdb_last_run_timestamp_seconds" : [f" {time.time()}"]}
+    for row in records:
+        tags = dict(row.tags)
+        sample_type = tags.pop("sample_type")
+        labels = ""
+        if tags:
+            labels = "{" + ",".join(f'{tag}="{tags[tag]}"' for tag in tags) + "}"
+        for name, value in zip(row.names, row.values):
+            metric = f"gadgetbridge_to_influxdb_{sample_type}_{name}"
+            families.setdefault(metric, []).append(f"{labels} {value}")
+
+    out = []
+    for metric in families:
+        out.append(f"# TYPE {metric} gauge")
+        out.extend(f"{metric}{sample}" for sample in families[metric])
+    return "\n".join(out) + "\n"
+
+
+def write_metrics_textfile(records):
+    ''' Write the self-monitoring points out in Prometheus text format
+    '''
+    tmp_file = f"{METRICS_TEXTFILE}.tmp"
+    with open(tmp_file, "w") as fh:
+        fh.write(format_metrics(records))
+    os.replace(tmp_file, METRICS_TEXTFILE)
+
+
+def report_metrics(write_api=None):
+    ''' Print a summary of the run's metrics and write them out
+
+    In one-shot mode this is registered to run at exit, so that failed
+    runs are reported too. There's only a handful of points, so without
+    a write_api they're posted directly. Returns the points
+    '''
+    records = metrics_records()
+    run = dict(zip(records[0].names, records[0].values))
+    # Only the stages: counters such as write_batch_max_seconds are timings
+    # too, but aren't part of the run's time
+    stages = sorted(METRICS.stage_times()) + ["overhead", "total"]
+    print("Run timings: " + ", ".join(f"{stage}={run[stage + '_seconds']:.3f}s" for stage in stages))
+    for row in records[1:]:
+        stats = dict(zip(row.names, row.values))
+        print(f"Task {dict(row.tags)['task']}: {stats['rows']} rows read in {stats['query_seconds']:.3f}s, "
+              f"{stats['points']} points in {stats['seconds']:.3f}s")
+
+    if METRICS_TEXTFILE:
+        try:
+            write_metrics_textfile(records)
+        except OSError as e:
+            print(f"Warning: unable to write metrics textfile: {e}")
+
+    if SELF_MONITOR_MEASUREMENT:
+        try:
+            write_results(records, SELF_MONITOR_MEASUREMENT, write_api or UrllibWriteAPI())
+        except Exception as e:
+            print(f"Warning: unable to write self-monitoring metrics: {e}")
+
+    return records
+
+
+def sync(source, state, write_api=None):
+    ''' Run a single sync: fetch the export from source (if it's
+    changed), extract data from it and write that into InfluxDB
+
+    state is updated in place. Returns the exit status
+    '''
+    with METRICS.timer("export_info"):
+        info = source.info()
+    if info is None:
+        return 1
+
+    # If the export hasn't changed since the last successful run
+    # there's nothing new to extract
+    if SKIP_UNCHANGED == "Y" and export_unchanged(info, state):
+        print("Export unchanged since last run, nothing to do")
+        write_results([export_check_row(info, False)], write_api=write_api)
+        return 0
+
+    with METRICS.timer("download"), (DOWNLOAD_SLOTS or contextlib.nullcontext()):
+        tempdir = source.fetch(info)
+
+    with METRICS.timer("open"):
+        conn, cur  = open_database(tempdir)
+
+    try:
+        devices = get_devices(cur)
+        if not devices:
+            print("Data extraction failed")
+            return 1
+
+        # Digests are only worth taking if they'll be around for the next run
+        digests = None
+        if DIFF_SYNC == "Y" and (STATE_FILE or DAEMON_MODE == "Y"):
+            digests = {}
+
+        # Extract data from the DB, streaming it out to InfluxDB
+        progress = {}
+        write_results(itertools.chain(
+            extract_data(cur, devices, state, progress, functools.partial(connect_readonly, tempdir), digests),
+            [export_check_row(info, True)]
+            ), write_api=write_api)
+
+        # The write succeeded, so move the high-water marks on
+        # and record which export we processed
+        state["export"] = export_fingerprint(info)
+        if digests is not None:
+            state["digests"] = digests
+        save_state(update_state(state, progress))
+    finally:
+        # Tidy up
+        conn.close()
+        remove_database(tempdir)
+
+    # The export can change without the watch having synced anything
+    # new, so an empty window isn't a failure
+    if not any(progress.values()):
+        print("No new data in the export")
+
+    return 0
+
+
+### Backfill
+#
+# Loading a long history in one go. The range is split into chunks,
+# each of which is extracted by a worker process and then written
+# into InfluxDB or into gzipped line protocol files for `influx write`.
+# A marker is left as each chunk completes, so an interrupted backfill
+# can be resumed.
+
+BACKFILL_CHUNKS = {
+    "day" : 86400,
+    "week" : 604800
+    }
+
+
+def parse_date(value):
+    ''' Convert a YYYY-MM-DD date (UTC) into a Unix timestamp
+    '''
+    return calendar.timegm(time.strptime(value, "%Y-%m-%d"))
+
+
+def backfill_chunks(start, end, step):
+    ''' Split start to end into chunks of step seconds, each labelled
+    with the date it starts on
+    '''
+    chunks = []
+    while start < end:
+        chunks.append((time.strftime("%Y-%m-%d", time.gmtime(start)), start, min(start + step, end)))
+        start += step
+    return chunks
+
+
+def chunk_done(progress_dir, label, start, end):
+    ''' Check whether a chunk was completed by an earlier backfill
+
+    The marker has to cover the same range, in case --chunk or --end
+    have changed since
+    '''
+    try:
+        with open(f"{progress_dir}/{label}.done", "r") as fh:
+            marker = json.load(fh)
+    except (OSError, ValueError):
+        return False
+    return marker.get("start") == start and marker.get("end") == end
+
+
+def write_backfill_files(rows, prefix):
+    ''' Write rows into gzipped line protocol files, one per precision
+    as `influx write` only accepts one precision per file
+
+    Files are only given their final names once complete. Returns the
+    number of points written
+    '''
+    files = {}
+    points = 0
+    try:
+        for row in rows:
+            if type(row) is LineBatch:
+                lines = row.lines
+            else:
+                line = serialize_row(row)
+                if line is None:
+                    continue
+                lines = [line]
+
+            if not lines:
+                continue
+            fh = files.get(row.precision)
+            if fh is None:
+                fh = files[row.precision] = gzip.open(f"{prefix}.{row.precision}.lp.gz.part", "wt",
+                                                      encoding="utf-8")
+            fh.write("\n".join(lines))
+            fh.write("\n")
+            points += len(lines)
+    finally:
+        for fh in files.values():
+            fh.close()
+
+    for precision in files:
+        os.replace(f"{prefix}.{precision}.lp.gz.part", f"{prefix}.{precision}.lp.gz")
+    return points
+
+
+def backfill_chunk(tempdir, devices, tasks, label, start, end, output, progress_dir):
+    ''' Extract and write a single chunk, in a worker process
+
+    Returns the number of points written
+    '''
+    conn = connect_readonly(tempdir)
+    cur = conn.cursor()
+    window = QueryWindow({}, start, end)
+    rows = itertools.chain.from_iterable(EXTRACTION_TASKS[task](cur, devices, window, {})
+                                         for task in tasks)
+    try:
+        if output:
+            points = write_backfill_files(rows, f"{output}/{label}")
+        else:
+            with open_influxdb() as _client:
+                with open_sync_write_api(_client) as write_api:
+                    points = write_results(rows, write_api=write_api)
+    finally:
+        conn.close()
+
+    with open(f"{progress_dir}/{label}.done", "w") as fh:
+        json.dump({"start" : start, "end" : end, "points" : points}, fh)
+    return points
+
+
+def run_backfill(source, args):
+    ''' Export everything between --start and --end
+
+    Returns the exit status: 1 if any chunk failed
+    '''
+    parser = argparse.ArgumentParser(prog="gadgetbridge_to_influxdb.py backfill",
+                                     description="Export a range of history, in parallel chunks")
+    parser.add_argument("--start", type=parse_date, required=True,
+                        help="First day to export (YYYY-MM-DD, UTC)")
+    parser.add_argument("--end", type=parse_date, required=True,
+                        help="Day to stop before (YYYY-MM-DD, UTC)")
+    parser.add_argument("--chunk", choices=list(BACKFILL_CHUNKS), default="day",
+                        help="How much to export in each chunk (default: day)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="How many chunks to process at once (default: number of CPUs)")
+    parser.add_argument("--output", default=None,
+                        help="Write gzipped line protocol files into this directory, rather than into InfluxDB")
+    parser.add_argument("--progress-dir", default=None,
+                        help="Where to record completed chunks (default: the output directory, or ./backfill_progress)")
+    args = parser.parse_args(args)
+
+    if not args.output and not INFLUXDB_URL:
+        print("Error: INFLUXDB_URL not set in environment")
+        return 1
+
+    if args.end <= args.start:
+        print("Error: --end must be after --start")
+        return 1
+
+    progress_dir = args.progress_dir or args.output or "backfill_progress"
+    os.makedirs(progress_dir, exist_ok=True)
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+
+    chunks = backfill_chunks(args.start, args.end, BACKFILL_CHUNKS[args.chunk])
+    pending = [c for c in chunks if not chunk_done(progress_dir, *c)]
+    print(f"Backfilling {len(pending)} chunks ({len(chunks) - len(pending)} already done)")
+    if not pending:
+        return 0
+    if ROLLUPS == "Y":
+        print("Note: rollups aren't written by backfill")
+
+    info = source.info()
+    if info is None:
+        return 1
+
+    # Workers open their own connections, so the database needs to be on disk
+    tempdir = source.fetch(info, in_memory=False)
+    failed = 0
+    try:
+        conn, cur = open_database(tempdir)
+        devices = get_devices(cur)
+        # Rollup buckets can straddle chunks, so only tasks which
+        # export rows are run
+        tasks = [task for task in available_tasks(cur) if task in TABLE_TIMESTAMP_UNITS]
+        conn.close()
+
+        with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+            futures = {pool.submit(backfill_chunk, tempdir, devices, tasks, label, start, end,
+                                   args.output, progress_dir) : label
+                       for label, start, end in pending}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    print(f"Chunk {futures[future]}: {future.result()} points")
+                except Exception as e:
+                    print(f"Error: chunk {futures[future]} failed: {e}")
+                    failed += 1
+    finally:
+        remove_database(tempdir)
+
+    if failed:
+        print(f"{failed} chunks failed, run again to retry them")
+        return 1
+    return 0
+
+
+### Tenants
+#
+# Many users' exports can be processed in a single pass. Each is handled
+# in a worker process, with that tenant's settings applied over the
+# global config. Workers hand their writes back to the parent, so there's
+# a single write path into InfluxDB
+
+def tenant_path(path, name, directory=False):
+    ''' Derive a per-tenant path from a global one, so that tenants
+    don't clobber each other's state, cache etc
+    '''
+    if not path:
+        return path
+    if directory:
+        return os.path.join(path, name)
+    root, ext = os.path.splitext(path)
+    return f"{root}.{name}{ext}"
+
+
+def load_tenants():
+    ''' Read and validate TENANTS_FILE
+
+    The file should contain a list of objects, each with a unique name
+    and any of the settings in TENANT_OPTIONS
+    '''
+    with open(TENANTS_FILE, "r") as fh:
+        tenants = json.load(fh)
+
+    names = set()
+    for tenant in tenants:
+        name = tenant.get("name")
+        if not name or name in names:
+            raise ValueError(f"Tenants must have unique names, got {name!r}")
+        names.add(name)
+
+        unknown = [key for key in tenant if key != "name" and key not in TENANT_OPTIONS]
+        if unknown:
+            raise ValueError(f"Tenant {name} has unsupported settings: {', '.join(unknown)}")
+
+        if not (tenant.get("WEBDAV_URL", WEBDAV_URL) or tenant.get("EXPORT_PATH", EXPORT_PATH)):
+            raise ValueError(f"Tenant {name} has neither WEBDAV_URL nor EXPORT_PATH")
+
+    return tenants
+
+
+def configure_tenant(tenant):
+    ''' Apply a tenant's settings over the global config
+
+    Values are given as they would be in the environment. The global
+    config is restored first, so a worker can process several tenants
+    '''
+    global BASE_CONFIG, TENANT_NAME
+    if BASE_CONFIG is None:
+        BASE_CONFIG = {name : globals()[name] for name in TENANT_OPTIONS.values()}
+    globals().update(BASE_CONFIG)
+
+    TENANT_NAME = tenant["name"]
+    globals()["STATE_FILE"] = tenant_path(STATE_FILE, TENANT_NAME)
+    globals()["METRICS_TEXTFILE"] = tenant_path(METRICS_TEXTFILE, TENANT_NAME)
+    globals()["EXPORT_CACHE_DIR"] = tenant_path(EXPORT_CACHE_DIR, TENANT_NAME, directory=True)
+
+    for key in tenant:
+        if key == "name":
+            continue
+        name = TENANT_OPTIONS[key]
+        value = tenant[key]
+        current = BASE_CONFIG[name]
+        if isinstance(current, list):
+            value = str(value).split(",")
+        elif isinstance(current, int) and not isinstance(current, bool):
+            value = int(value)
+        globals()[name] = value
+
+
+class QueueWriteAPI:
+    ''' Stands in for the InfluxDB write API in tenant workers
+
+    Each batch is handed to the parent process to write, and we wait
+    to hear back, so writes fail (and state isn't saved) just as they
+    would if we were writing directly
+    '''
+
+    def __init__(self, name, requests, replies):
+        self.name = name
+        self.requests = requests
+        self.replies = replies
+
+    def write(self, bucket, org, record, write_precision):
+        self.requests.put(("write", self.name, bucket, org, write_precision, record))
+        error = self.replies.get()
+        if error is not None:
+            raise RuntimeError(f"Write failed: {error}")
+
+
+def run_tenant(tenant, requests, replies, download_slots):
+    ''' Sync a single tenant's export, in a worker process
+
+    Always finishes by telling the parent that we're done
+    '''
+    global METRICS, DOWNLOAD_SLOTS
+    status = 1
+    try:
+        configure_tenant(tenant)
+        METRICS = RunMetrics()
+        DOWNLOAD_SLOTS = download_slots
+        print(f"Processing tenant {TENANT_NAME}")
+
+        write_api = QueueWriteAPI(TENANT_NAME, requests, replies)
+        status = sync(make_source(), load_state(), write_api)
+        report_metrics(write_api)
+    except Exception as e:
+        print(f"Error: tenant {tenant.get('name')} failed: {e}")
+    finally:
+        requests.put(("done", tenant.get("name"), status))
+
+
+def run_tenants(tenants):
+    ''' Sync every tenant, TENANT_WORKERS at a time, writing their
+    data into InfluxDB as it arrives
+
+    Returns the exit status: 1 if any tenant failed
+    '''
+    manager = multiprocessing.Manager()
+    requests = manager.Queue(EXTRACT_QUEUE_SIZE)
+    replies = {tenant["name"] : manager.Queue() for tenant in tenants}
+    download_slots = manager.BoundedSemaphore(DOWNLOAD_CONCURRENCY)
+    statuses = {}
+
+    try:
+        with open_write_api() as write_api:
+            with concurrent.futures.ProcessPoolExecutor(TENANT_WORKERS) as pool:
+                futures = {pool.submit(run_tenant, tenant, requests, replies[tenant["name"]],
+                                       download_slots) : tenant["name"]
+                           for tenant in tenants}
+
+                while len(statuses) < len(tenants):
+                    try:
+                        message = requests.get(timeout=1)
+                    except queue.Empty:
+                        # A worker which died won't have told us it was done
+                        for future in futures:
+                            if future.done() and future.exception() is not None:
+                                statuses.setdefault(futures[future], 1)
+                        continue
+
+                    if message[0] == "done":
+                        statuses[message[1]] = message[2]
+                        continue
+
+                    name, bucket, org, precision, record = message[1:]
+                    try:
+                        write_api.write(bucket, org, record=record, write_precision=precision)
+                        replies[name].put(None)
+                    except Exception as e:
+                        replies[name].put(str(e))
+    finally:
+        manager.shutdown()
+
+    for name in statuses:
+        print(f"Tenant {name}: {'ok' if statuses[name] == 0 else 'failed'}")
+
+    return 1 if any(statuses.values()) else 0
+
+
+### Daemon mode
+#
+# Rather than being started for each run, the script stays resident
+# and polls the export. The WebDAV and InfluxDB clients are kept open
+# between runs, so their connections get reused
+
+# The outcome of recent runs, reported by the health endpoint
+DAEMON_STATUS = {
+    "started" : time.time(),
+    "last_run" : None,
+    "last_success" : None,
+    "last_status" : None,
+    "consecutive_failures" : 0,
+    "runs" : 0
+    }
+
+# The self-monitoring points from the last run, served on /metrics
+LAST_METRICS = []
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    ''' Serve /health (JSON, 503 if recent runs have failed) and
+    /metrics (the last run's metrics, in Prometheus text format)
+    '''
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path == "/health":
+            code = 200
+            if DAEMON_STATUS["consecutive_failures"] >= 3:
+                code = 503
+            self._respond(code, "application/json", json.dumps(DAEMON_STATUS))
+        elif path == "/metrics":
+            self._respond(200, "text/plain; version=0.0.4", format_metrics(LAST_METRICS))
+        else:
+            self._respond(404, "text/plain", "Not found\n")
+
+    def _respond(self, code, content_type, body):
+        payload = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_health_server():
+    ''' Serve HealthHandler from a background thread
+    '''
+    server = ThreadingHTTPServer((HEALTH_ADDRESS, HEALTH_PORT), HealthHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"Health endpoint listening on {HEALTH_ADDRESS}:{HEALTH_PORT}")
+    return server
+
+
+def run_daemon(source):
+    ''' Sync every POLL_INTERVAL (+ jitter) seconds until told to stop
+
+    SIGTERM and SIGINT let the current run finish (and so flush its
+    writes) before exiting
+    '''
+    global METRICS, LAST_METRICS
+
+    stop = threading.Event()
+    def request_stop(signum, frame):
+        print("Received signal, stopping after the current run")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    server = start_health_server() if HEALTH_PORT else None
+    state = load_state()
+    with open_write_api() as write_api:
+        while not stop.is_set():
+            METRICS = RunMetrics()
+            try:
+                status = sync(source, state, write_api)
+            except Exception as e:
+                print(f"Error: run failed: {e}")
+                status = 1
+
+            DAEMON_STATUS["runs"] += 1
+            DAEMON_STATUS["last_run"] = time.time()
+            DAEMON_STATUS["last_status"] = status
+            if status == 0:
+                DAEMON_STATUS["last_success"] = DAEMON_STATUS["last_run"]
+                DAEMON_STATUS["consecutive_failures"] = 0
+            else:
+                DAEMON_STATUS["consecutive_failures"] += 1
+            LAST_METRICS = report_metrics(write_api)
+
+            source.wait(POLL_INTERVAL + random.uniform(0, POLL_JITTER), stop)
+
+    if server is not None:
+        server.shutdown()
+    print("Stopped")
+    return 0
+
+
+if __name__ == "__main__":
+    backfill = sys.argv[1:2] == ["backfill"]
+    errors = validate_config(backfill)
+    for error in errors:
+        print(f"Error: {error}")
+    if errors:
+        sys.exit(1)
+
+    if TENANTS_FILE and not backfill:
+        try:
+            tenants = load_tenants()
+        except (OSError, ValueError) as e:
+            print(f"Error: unable to load TENANTS_FILE: {e}")
+            sys.exit(1)
+        sys.exit(run_tenants(tenants))
+
+    if backfill:
+        sys.exit(run_backfill(make_source(), sys.argv[2:]))
+
+    if DAEMON_MODE == "Y":
+        sys.exit(run_daemon(make_source()))
+
+    atexit.register(report_metrics)
+    source = make_source()
+    state = load_state()
+    if preflight(source, state):
+        sys.exit(0)
+    sys.exit(sync(source, state))
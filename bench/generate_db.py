@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#
+# Generate a synthetic Gadgetbridge database
+#
+# The schema mirrors the subset of tables (and columns) that
+# gadgetbridge_to_influxdb.py reads, so that runs can be
+# benchmarked without needing a real watch export
+#
+# Copyright (c) 2023, B Tasker
+# Released under BSD 3-clause
+#
+import argparse
+import os
+import random
+import sqlite3
+import time
+
+
+SCHEMA = [
+    ('CREATE TABLE DEVICE ("_id" INTEGER PRIMARY KEY AUTOINCREMENT, "NAME" TEXT NOT NULL, '
+     '"MANUFACTURER" TEXT NOT NULL, "IDENTIFIER" TEXT NOT NULL UNIQUE, "TYPE" INTEGER NOT NULL, '
+     '"MODEL" TEXT, "ALIAS" TEXT)'),
+    ('CREATE TABLE USER ("_id" INTEGER PRIMARY KEY AUTOINCREMENT, "NAME" TEXT NOT NULL)'),
+    ('CREATE TABLE HUAMI_SPO2_SAMPLE ("TIMESTAMP" INTEGER NOT NULL, "DEVICE_ID" INTEGER NOT NULL, '
+     '"USER_ID" INTEGER NOT NULL, "TYPE_NUM" INTEGER NOT NULL, "SPO2" INTEGER NOT NULL, '
+     'PRIMARY KEY ("TIMESTAMP", "DEVICE_ID") ON CONFLICT REPLACE) WITHOUT ROWID'),
+    ('CREATE TABLE HUAMI_STRESS_SAMPLE ("TIMESTAMP" INTEGER NOT NULL, "DEVICE_ID" INTEGER NOT NULL, '
+     '"USER_ID" INTEGER NOT NULL, "TYPE_NUM" INTEGER NOT NULL, "STRESS" INTEGER NOT NULL, '
+     'PRIMARY KEY ("TIMESTAMP", "DEVICE_ID") ON CONFLICT REPLACE) WITHOUT ROWID'),
+    ('CREATE TABLE HUAMI_SLEEP_RESPIRATORY_RATE_SAMPLE ("TIMESTAMP" INTEGER NOT NULL, '
+     '"DEVICE_ID" INTEGER NOT NULL, "USER_ID" INTEGER NOT NULL, "RATE" INTEGER NOT NULL, '
+     'PRIMARY KEY ("TIMESTAMP", "DEVICE_ID") ON CONFLICT REPLACE) WITHOUT ROWID'),
+    ('CREATE TABLE HUAMI_PAI_SAMPLE ("TIMESTAMP" INTEGER NOT NULL, "DEVICE_ID" INTEGER NOT NULL, '
+     '"USER_ID" INTEGER NOT NULL, "UTC_OFFSET" INTEGER, "PAI_LOW" REAL NOT NULL, '
+     '"PAI_MODERATE" REAL NOT NULL, "PAI_HIGH" REAL NOT NULL, "TIME_LOW" INTEGER NOT NULL, '
+     '"TIME_MODERATE" INTEGER NOT NULL, "TIME_HIGH" INTEGER NOT NULL, "PAI_TODAY" REAL NOT NULL, '
+     '"PAI_TOTAL" REAL NOT NULL, '
+     'PRIMARY KEY ("TIMESTAMP", "DEVICE_ID") ON CONFLICT REPLACE) WITHOUT ROWID'),
+    ('CREATE TABLE BATTERY_LEVEL ("TIMESTAMP" INTEGER NOT NULL, "DEVICE_ID" INTEGER NOT NULL, '
+     '"LEVEL" INTEGER NOT NULL, "BATTERY_INDEX" INTEGER NOT NULL, '
+     'PRIMARY KEY ("TIMESTAMP", "DEVICE_ID", "BATTERY_INDEX") ON CONFLICT REPLACE) WITHOUT ROWID'),
+    ('CREATE TABLE HUAMI_HEART_RATE_MANUAL_SAMPLE ("TIMESTAMP" INTEGER NOT NULL, '
+     '"DEVICE_ID" INTEGER NOT NULL, "USER_ID" INTEGER NOT NULL, "UTC_OFFSET" INTEGER, '
+     '"HEART_RATE" INTEGER NOT NULL, '
+     'PRIMARY KEY ("TIMESTAMP", "DEVICE_ID") ON CONFLICT REPLACE) WITHOUT ROWID'),
+    ('CREATE TABLE HUAMI_HEART_RATE_MAX_SAMPLE ("TIMESTAMP" INTEGER NOT NULL, '
+     '"DEVICE_ID" INTEGER NOT NULL, "USER_ID" INTEGER NOT NULL, "UTC_OFFSET" INTEGER, '
+     '"HEART_RATE" INTEGER NOT NULL, '
+     'PRIMARY KEY ("TIMESTAMP", "DEVICE_ID") ON CONFLICT REPLACE) WITHOUT ROWID'),
+    ('CREATE TABLE HUAMI_HEART_RATE_RESTING_SAMPLE ("TIMESTAMP" INTEGER NOT NULL, '
+     '"DEVICE_ID" INTEGER NOT NULL, "USER_ID" INTEGER NOT NULL, "UTC_OFFSET" INTEGER, '
+     '"HEART_RATE" INTEGER NOT NULL, '
+     'PRIMARY KEY ("TIMESTAMP", "DEVICE_ID") ON CONFLICT REPLACE) WITHOUT ROWID'),
+    ('CREATE TABLE HUAMI_EXTENDED_ACTIVITY_SAMPLE ("TIMESTAMP" INTEGER NOT NULL, '
+     '"DEVICE_ID" INTEGER NOT NULL, "USER_ID" INTEGER NOT NULL, "RAW_INTENSITY" INTEGER NOT NULL, '
+     '"STEPS" INTEGER NOT NULL, "RAW_KIND" INTEGER NOT NULL, "HEART_RATE" INTEGER NOT NULL, '
+     '"UNKNOWN1" INTEGER, "SLEEP" INTEGER, "DEEP_SLEEP" INTEGER, "REM_SLEEP" INTEGER, '
+     'PRIMARY KEY ("TIMESTAMP", "DEVICE_ID") ON CONFLICT REPLACE) WITHOUT ROWID'),
+    ('CREATE TABLE MI_BAND_ACTIVITY_SAMPLE ("TIMESTAMP" INTEGER NOT NULL, '
+     '"DEVICE_ID" INTEGER NOT NULL, "USER_ID" INTEGER NOT NULL, "RAW_INTENSITY" INTEGER NOT NULL, '
+     '"STEPS" INTEGER NOT NULL, "RAW_KIND" INTEGER NOT NULL, "HEART_RATE" INTEGER NOT NULL, '
+     'PRIMARY KEY ("TIMESTAMP", "DEVICE_ID") ON CONFLICT REPLACE) WITHOUT ROWID'),
+    ]
+
+# RAW_KIND values used for sleep phases
+# (waking, light, deep, REM, very light)
+SLEEP_KINDS = [112, 120, 121, 122, 249]
+
+
+def generate(path, devices=1, days=7, interval=60, stress_interval=300, seed=None, end=None):
+    ''' Build a synthetic database at path
+
+    interval is the sampling period (in seconds) of the activity tables,
+    stress_interval the period of the stress samples
+    '''
+    rng = random.Random(seed)
+    end = int(end if end else time.time())
+    end -= end % 60
+    start = end - (days * 86400)
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    for stmt in SCHEMA:
+        cur.execute(stmt)
+
+    cur.execute("INSERT INTO USER (_id, NAME) VALUES (1, 'bench')")
+    for dev in range(1, devices + 1):
+        cur.execute("INSERT INTO DEVICE (_id, NAME, MANUFACTURER, IDENTIFIER, TYPE) VALUES (?, ?, ?, ?, ?)",
+                    (dev, f"Amazfit Bip {dev}", "Huami", f"AA:BB:CC:DD:EE:{dev:02X}", 1))
+
+        activity = []
+        extended = []
+        for ts in range(start, end, interval):
+            hour = (ts // 3600) % 24
+            if hour < 7:
+                # Sleeping - runs of a single phase lasting 10-40 minutes
+                if ts % 1800 < interval or not activity:
+                    kind = rng.choice(SLEEP_KINDS)
+                else:
+                    kind = activity[-1][5]
+                steps = 0
+            else:
+                kind = rng.choice([1, 16, 17, 80, 90])
+                steps = rng.randint(0, 120)
+            hr = rng.choice([rng.randint(50, 140)] * 20 + [254, 255])
+            activity.append((ts, dev, 1, rng.randint(0, 255), steps, kind, hr))
+            extended.append((ts, dev, 1, rng.randint(0, 255), steps, kind, hr, 0,
+                             int(kind in (120, 249)), int(kind == 121), int(kind == 122)))
+
+        cur.executemany("INSERT INTO MI_BAND_ACTIVITY_SAMPLE VALUES (?, ?, ?, ?, ?, ?, ?)", activity)
+        cur.executemany("INSERT INTO HUAMI_EXTENDED_ACTIVITY_SAMPLE VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        extended)
+
+        cur.executemany("INSERT INTO HUAMI_STRESS_SAMPLE VALUES (?, ?, ?, ?, ?)",
+                        [(ts * 1000, dev, 1, 0, rng.randint(1, 100))
+                         for ts in range(start, end, stress_interval)])
+        cur.executemany("INSERT INTO HUAMI_SPO2_SAMPLE VALUES (?, ?, ?, ?, ?)",
+                        [(ts * 1000, dev, 1, 0, rng.randint(90, 100)) for ts in range(start, end, 3600)])
+        cur.executemany("INSERT INTO HUAMI_SLEEP_RESPIRATORY_RATE_SAMPLE VALUES (?, ?, ?, ?)",
+                        [(ts * 1000, dev, 1, rng.randint(10, 20)) for ts in range(start, end, 3600)
+                         if (ts // 3600) % 24 < 7])
+        cur.executemany("INSERT INTO HUAMI_PAI_SAMPLE VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(ts * 1000, dev, 1, 0, rng.random() * 5, rng.random() * 5, rng.random() * 5,
+                          rng.randint(0, 60), rng.randint(0, 60), rng.randint(0, 60),
+                          rng.random() * 20, rng.random() * 100)
+                         for ts in range(start, end, 86400)])
+        cur.executemany("INSERT INTO BATTERY_LEVEL VALUES (?, ?, ?, ?)",
+                        [(ts, dev, rng.randint(0, 100), 0) for ts in range(start, end, 1800)])
+        for table in ("HUAMI_HEART_RATE_MANUAL_SAMPLE", "HUAMI_HEART_RATE_MAX_SAMPLE",
+                      "HUAMI_HEART_RATE_RESTING_SAMPLE"):
+            cur.executemany(f"INSERT INTO {table} VALUES (?, ?, ?, ?, ?)",
+                            [(ts * 1000, dev, 1, 0, rng.randint(45, 180)) for ts in range(start, end, 21600)])
+
+    conn.commit()
+    conn.close()
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Gadgetbridge database")
+    parser.add_argument("path", help="Where to write the database")
+    parser.add_argument("--devices", type=int, default=1, help="Number of devices")
+    parser.add_argument("--days", type=int, default=7, help="Days of history")
+    parser.add_argument("--interval", type=int, default=60,
+                        help="Activity sampling interval in seconds (default 60)")
+    parser.add_argument("--stress-interval", type=int, default=300,
+                        help="Stress sampling interval in seconds (default 300)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed")
+    parser.add_argument("--end", type=int, default=None,
+                        help="Epoch (seconds) that the data should end at (default: now)")
+    args = parser.parse_args()
+
+    generate(args.path, devices=args.devices, days=args.days, interval=args.interval,
+             stress_interval=args.stress_interval, seed=args.seed, end=args.end)
+    print(args.path)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+#
+# Benchmark gadgetbridge_to_influxdb.py against a synthetic
+# (or supplied) Gadgetbridge database
+#
+# Extraction, sleep expansion and serialization are timed
+# separately, optionally followed by a write into a local
+# stub of the InfluxDB write API
+#
+# Copyright (c) 2023, B Tasker
+# Released under BSD 3-clause
+#
+import argparse
+import contextlib
+import json
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "app"))
+
+# These need to be in place before the script is imported, as
+# it reads its config at import time. Sleep extraction is
+# experimental, so needs enabling
+os.environ.setdefault("EXPERIMENTAL_OPTS", "SLEEP")
+os.environ.setdefault("QUERY_DURATION", "315360000")
+
+import gadgetbridge_to_influxdb as app
+from generate_db import generate
+from stub_influxdb import start_stub
+
+
+def drain(rows):
+    ''' Consume an extraction generator, separating Records from
+    LineBatches (which have already been serialized)
+    '''
+    records = []
+    batches = []
+    for row in rows:
+        if type(row) is app.LineBatch:
+            batches.append(row)
+        else:
+            records.append(row)
+    return records, batches
+
+
+def count_points(records, batches):
+    return len(records) + sum(len(b.lines) for b in batches)
+
+
+def stage_extract(cur, devices):
+    ''' Run every enabled extraction task other than sleep
+    '''
+    window = app.make_window({}, int(time.time()) - app.QUERY_DURATION)
+    records = []
+    batches = []
+    for task in app.EXTRACTION_TASKS:
+        if task == "sleep" or not app.task_enabled(task):
+            continue
+        r, b = drain(app.EXTRACTION_TASKS[task](cur, devices, window, {}))
+        records.extend(r)
+        batches.extend(b)
+    return records, batches
+
+
+def stage_sleep(cur, devices):
+    ''' Fetch and expand sleep data
+    '''
+    window = app.make_window({}, int(time.time()) - app.QUERY_DURATION)
+    return drain(app.get_sleep_data(cur, devices, window, {}))
+
+
+def stage_serialize(records):
+    ''' Serialize records into line protocol
+    '''
+    lines = 0
+    for row in records:
+        if app.serialize_row(row) is not None:
+            lines += 1
+    return lines
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def traced_peak(func, *args):
+    ''' Run func under tracemalloc, returning the peak of Python
+    allocations (in bytes) while it ran
+    '''
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_pipeline(cur, devices):
+    ''' Stream everything through serialization, as a real run would,
+    without retaining the output
+    '''
+    lines = 0
+    for row in app.extract_data(cur, devices):
+        if type(row) is app.LineBatch:
+            lines += len(row.lines)
+        elif app.serialize_row(row) is not None:
+            lines += 1
+    return lines
+
+
+def benchmark(db_file, write=False, memory=False):
+    ''' Run each stage against db_file and return the results
+    '''
+    conn = sqlite3.connect(db_file)
+    cur = conn.cursor()
+    devices = app.get_devices(cur)
+    results = {"engine": "numpy" if app.column_engine_enabled() else "python", "stages": {}}
+
+    (records, batches), duration = timed(stage_extract, cur, devices)
+    results["stages"]["extraction"] = (count_points(records, batches), duration)
+
+    (sleep_records, sleep_batches), duration = timed(stage_sleep, cur, devices)
+    results["stages"]["sleep_expansion"] = (count_points(sleep_records, sleep_batches), duration)
+
+    # LineBatches were serialized during extraction, so only the
+    # Records are counted here
+    lines, duration = timed(stage_serialize, records + sleep_records)
+    results["stages"]["serialization"] = (lines, duration)
+    del records, batches, sleep_records, sleep_batches
+
+    lines, duration = timed(run_pipeline, cur, devices)
+    results["stages"]["pipeline"] = (lines, duration)
+
+    if write:
+        server, stats = start_stub()
+        app.INFLUXDB_URL = f"http://127.0.0.1:{server.server_address[1]}"
+        lines, duration = timed(app.write_results, app.extract_data(cur, devices))
+        results["stages"]["write"] = (lines, duration)
+        results["stub"] = stats.as_dict()
+        server.shutdown()
+
+    if memory:
+        results["pipeline_peak_bytes"] = traced_peak(run_pipeline, cur, devices)
+
+    # ru_maxrss is in KiB on Linux
+    results["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    conn.close()
+    return results
+
+
+def report(results):
+    print(f"Expansion engine: {results['engine']}")
+    print(f"{'stage':<18}{'points':>10}{'seconds':>10}{'points/s':>12}")
+    for stage in results["stages"]:
+        points, duration = results["stages"][stage]
+        rate = points / duration if duration else 0
+        print(f"{stage:<18}{points:>10}{duration:>10.3f}{rate:>12.0f}")
+
+    if "pipeline_peak_bytes" in results:
+        print(f"Peak traced allocations (pipeline): {results['pipeline_peak_bytes'] / 1048576:.1f} MiB")
+    print(f"Peak RSS: {results['peak_rss_bytes'] / 1048576:.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark gadgetbridge_to_influxdb")
+    parser.add_argument("--db", default=None,
+                        help="Existing database to benchmark against (default: generate one)")
+    parser.add_argument("--devices", type=int, default=1, help="Number of devices to generate")
+    parser.add_argument("--days", type=int, default=30, help="Days of history to generate")
+    parser.add_argument("--interval", type=int, default=60,
+                        help="Activity sampling interval in seconds (default 60)")
+    parser.add_argument("--stress-interval", type=int, default=300,
+                        help="Stress sampling interval in seconds (default 300)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for generation")
+    parser.add_argument("--engine", choices=["auto", "python"], default="auto",
+                        help="Expansion engine to use")
+    parser.add_argument("--write", action="store_true",
+                        help="Also time a full write into a local stub of the InfluxDB API")
+    parser.add_argument("--memory", action="store_true",
+                        help="Trace Python allocations during a pipeline run (slow)")
+    parser.add_argument("--json", action="store_true", help="Output results as JSON")
+    args = parser.parse_args()
+
+    app.EXPANSION_ENGINE = args.engine
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        db_file = args.db
+        if not db_file:
+            db_file, duration = timed(generate, os.path.join(tempdir, "gadgetbridge.sqlite"),
+                                      args.devices, args.days, args.interval,
+                                      args.stress_interval, args.seed)
+            if not args.json:
+                print(f"Generated {args.days} days for {args.devices} device(s) in {duration:.1f}s")
+
+        # Keep the script's own messages out of the JSON
+        with contextlib.redirect_stdout(sys.stderr if args.json else sys.stdout):
+            results = benchmark(db_file, write=args.write, memory=args.memory)
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        report(results)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#
+# A minimal stand-in for the InfluxDB write API
+#
+# Accepts (optionally gzipped) line protocol on /api/v2/write and
+# /write, counts what it receives and then throws it away.
+#
+# Copyright (c) 2023, B Tasker
+# Released under BSD 3-clause
+#
+import argparse
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class StubStats:
+    ''' Counters shared between request handlers
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.lines = 0
+        self.bytes = 0
+        self.bytes_decompressed = 0
+        self.precisions = {}
+        self.captured = []
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "lines": self.lines,
+            "bytes": self.bytes,
+            "bytes_decompressed": self.bytes_decompressed,
+            "precisions": self.precisions
+            }
+
+
+def make_handler(stats, capture=False, fail_every=0):
+    ''' Build a request handler bound to stats
+
+    If capture is True, received lines are retained in stats.captured
+    If fail_every is set, every Nth write will receive a 503
+    '''
+
+    class StubHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path in ("/health", "/ping"):
+                self._respond(200, {"status": "pass"})
+            elif path == "/stats":
+                with stats.lock:
+                    self._respond(200, stats.as_dict())
+            else:
+                self._respond(404, {"message": "not found"})
+
+        def do_POST(self):
+            parsed = urlparse(self.path)
+            if parsed.path not in ("/api/v2/write", "/write"):
+                self._respond(404, {"message": "not found"})
+                return
+
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            raw_len = len(body)
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+
+            qs = parse_qs(parsed.query)
+            precision = qs.get("precision", ["ns"])[0]
+            lines = [l for l in body.decode("utf-8").split("\n") if l]
+
+            with stats.lock:
+                stats.requests += 1
+                if fail_every and stats.requests % fail_every == 0:
+                    self._respond(503, {"message": "stub induced failure"})
+                    return
+                stats.lines += len(lines)
+                stats.bytes += raw_len
+                stats.bytes_decompressed += len(body)
+                stats.precisions[precision] = stats.precisions.get(precision, 0) + len(lines)
+                if capture:
+                    stats.captured.extend((precision, l) for l in lines)
+
+            self.send_response(204)
+            self.end_headers()
+
+        def _respond(self, code, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return StubHandler
+
+
+def start_stub(port=0, capture=False, fail_every=0):
+    ''' Start the stub in a background thread
+
+    Returns the server (use server.server_address for the port)
+    and the stats object
+    '''
+    stats = StubStats()
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(stats, capture, fail_every))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub InfluxDB write endpoint")
+    parser.add_argument("--port", type=int, default=8086)
+    parser.add_argument("--fail-every", type=int, default=0,
+                        help="Return a 503 for every Nth write")
+    args = parser.parse_args()
+
+    server, stats = start_stub(args.port, fail_every=args.fail_every)
+    print(f"Listening on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(10)
+            with stats.lock:
+                print(json.dumps(stats.as_dict()))
+    except KeyboardInterrupt:
+        server.shutdown()